@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+import process_results as results
+import process_folders
+import stages
+
+# Synthetic records are written as <campaign>/<backend>/retrieve/<experiment>/<host>.csv, like
+# accumulated_csv_records, so that both the per-file stages and the whole pipeline can be measured
+BENCHMARK_DIR = './benchmark_records'
+REPORT_FILE = 'benchmark_report.json'
+CONFIG_FILE = 'config.json'
+
+SIZES = [4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+EXPERIMENTS = ['normal', 'do-not-cache', 'disconnect', 'do-not-cache-disconnect']
+BACKENDS = ['ipfs', 'swarm']
+SITES = ['lille', 'grenoble', 'nancy', 'rennes', 'sophia']
+
+def host_names(hosts):
+    # degroot is the client outside grid5000, the rest are spread over the sites
+    return ['degroot'] + [f'node-{i}.{SITES[i % len(SITES)]}.grid5000.fr' for i in range(1, hosts)]
+
+def write_records(file_path, rng, rounds=25, na_ratio=0.05, repo_size=True, start=pd.Timestamp('2023-06-11 19:52:10')):
+    # Every round retrieves each size once, at the same date. Times are lognormal around a
+    # size dependent latency, with a heavy (Pareto) tail on a few percent of the retrievals.
+    sizes = np.tile(SIZES, rounds)
+    dates = (start + pd.to_timedelta(np.arange(rounds) * 60 + rng.integers(0, 30, rounds), unit='s')).strftime(results.DATE_FORMAT)
+    dates = np.repeat(dates, len(SIZES))
+
+    latencies = 100 + sizes / 4000
+    times = latencies * rng.lognormal(0, 0.5, len(sizes)) * (1 + (rng.random(len(sizes)) < 0.05) * rng.pareto(1.2, len(sizes)))
+    repo_sizes = sizes + rng.integers(11, 15, len(sizes))
+    na = rng.random(len(sizes)) < na_ratio
+
+    if repo_size:
+        header = 'Date,Retrieval Time (ms),Size in Repo(Bytes),Type,Size (Bytes)'
+        na_row = '-,-,-,-,-'
+        rows = [f'{date},{time:.4f},{repo},string,{size}' for date, time, repo, size in zip(dates, times, repo_sizes, sizes)]
+    else:
+        # Swarm records don't have the size in the repo
+        header = 'Date,Retrieval Time (ms),Type,Size (Bytes)'
+        na_row = '-,-,-,-'
+        rows = [f'{date},{time:.4f},string,{size}' for date, time, size in zip(dates, times, sizes)]
+
+    rows = [na_row if is_na else row for row, is_na in zip(rows, na)]
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as f:
+        f.write(header + '\n' + '\n'.join(rows) + '\n')
+
+def generate_records(records_dir=BENCHMARK_DIR, campaigns=1, hosts=6, experiments=4, rounds=25, na_ratio=0.05, seed=0):
+    # Returns the root directories (<campaign>/<backend>/retrieve) of the generated tree.
+    # A tree generated with the same configuration is reused.
+    config = {'campaigns': campaigns, 'hosts': hosts, 'experiments': experiments, 'rounds': rounds, 'na_ratio': na_ratio, 'seed': seed}
+    roots = [os.path.join(records_dir, f'campaign-{campaign}', backend, 'retrieve') for campaign in range(campaigns) for backend in BACKENDS]
+
+    try:
+        with open(os.path.join(records_dir, CONFIG_FILE)) as f:
+            if json.load(f) == config:
+                return roots
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(records_dir, ignore_errors=True)
+    rng = np.random.default_rng(seed)
+    experiment_names = [EXPERIMENTS[i % len(EXPERIMENTS)] + (f'-{i // len(EXPERIMENTS)}' if i >= len(EXPERIMENTS) else '') for i in range(experiments)]
+
+    for root_dir in roots:
+        print('Generating records under:', root_dir)
+        for experiment in experiment_names:
+            for host in host_names(hosts):
+                write_records(os.path.join(root_dir, experiment, f'{host}.csv'), rng, rounds, na_ratio, repo_size='/swarm/' not in root_dir)
+
+    with open(os.path.join(records_dir, CONFIG_FILE), 'w') as f:
+        json.dump(config, f)
+
+    return roots
+
+class StageTimer:
+    # Total time, calls and peak memory allocated (tracemalloc) of every named stage
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stages = {}
+
+    def measure(self, name, function, *args, **kwargs):
+        if self.memory:
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'peak_bytes': 0})
+        stage['calls'] += 1
+        stage['seconds'] += elapsed
+        if self.memory:
+            stage['peak_bytes'] = max(stage['peak_bytes'], tracemalloc.get_traced_memory()[1] - baseline)
+
+        return value
+
+    def timed(self, name, function):
+        return lambda *args, **kwargs: self.measure(name, function, *args, **kwargs)
+
+def benchmark_stages(files, functions, output_dir, memory=True):
+    # Run the functions list on every file on its own, timing the read, every stage of the
+    # compiled functions (dropna, groupby, outlier split, each function) and every output writer
+    timer = StageTimer(memory)
+    dag = stages.compile_stages(functions, dropna=True)
+    dag['stages'] = {key: (timer.timed(function.__name__, function), args, kwargs) for key, (function, args, kwargs) in dag['stages'].items()}
+
+    def output(index, data):
+        func_info = functions[index]
+        if 'output_function' in func_info:
+            writer = func_info['output_function']
+            timer.measure(f'{writer.__name__} ({func_info["output_dir"]})', writer, data, os.path.join(output_dir, func_info['output_dir']), name)
+
+    if memory:
+        tracemalloc.start()
+
+    for file_path in files:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        data = timer.measure('read', results.read_all, file_path, dropna=False)
+        stages.run_stages(dag, data, output, workers=1)
+
+    if memory:
+        tracemalloc.stop()
+
+    return timer.stages
+
+def benchmark_pipeline(roots, functions, jobs=1):
+    # The whole process_folders run over the generated roots
+    start = time.perf_counter()
+    errors = process_folders.process_roots(roots, 'Retrieval Time (ms)', functions, jobs=jobs)
+    elapsed = time.perf_counter() - start
+
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    # ru_maxrss is in kilobytes on Linux
+    return {'seconds': elapsed, 'max_rss_bytes': max(usage, children) * 1024, 'errors': len(errors)}
+
+# Imports a run of the scripts starts with, and the plotting modules they should leave unloaded
+STARTUP_MODULES = ['process_results', 'process_folders']
+PLOTTING_MODULES = ['matplotlib', 'matplotlib.pyplot', 'seaborn']
+
+def benchmark_startup(modules=STARTUP_MODULES, repeats=5):
+    # Median wall time of a new interpreter importing each module, and the plotting modules the import loaded
+    startup = {}
+    for module in modules:
+        code = f'import sys, {module}; print(",".join(m for m in {PLOTTING_MODULES!r} if m in sys.modules))'
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            loaded = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.strip()
+            times.append(time.perf_counter() - start)
+
+        startup[module] = {'seconds': float(np.median(times)), 'plotting_modules': loaded.split(',') if loaded else []}
+
+    return startup
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+def compare_reports(old, new):
+    # Seconds per stage of two reports and their ratio, slowest stages first
+    rows = []
+    for name, stage in new['stages'].items():
+        old_seconds = old['stages'].get(name, {}).get('seconds', np.nan)
+        rows.append({'Stage': name, 'Old (s)': old_seconds, 'New (s)': stage['seconds'], 'Ratio': stage['seconds'] / old_seconds if old_seconds else np.nan})
+
+    for scope in ['pipeline']:
+        if scope in old and scope in new:
+            rows.append({'Stage': scope, 'Old (s)': old[scope]['seconds'], 'New (s)': new[scope]['seconds'], 'Ratio': new[scope]['seconds'] / old[scope]['seconds']})
+
+    for module, startup in new.get('startup', {}).items():
+        if module in old.get('startup', {}):
+            old_seconds = old['startup'][module]['seconds']
+            rows.append({'Stage': f'import {module}', 'Old (s)': old_seconds, 'New (s)': startup['seconds'], 'Ratio': startup['seconds'] / old_seconds})
+
+    return pd.DataFrame(rows).sort_values('New (s)', ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the processing pipeline on synthetic CSV records')
+    parser.add_argument('--records-dir', default=BENCHMARK_DIR)
+    parser.add_argument('--campaigns', type=int, default=1, help='copies of the whole tree, each with every backend')
+    parser.add_argument('--hosts', type=int, default=6)
+    parser.add_argument('--experiments', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=25, help='rows per size in every file')
+    parser.add_argument('--na-ratio', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--outputs', nargs='+', help='output_dir of the functions to run, all of them by default')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracing the memory of the stages, which slows them down')
+    parser.add_argument('--pipeline', action='store_true', help='also time a full process_folders run over the records')
+    parser.add_argument('--jobs', type=int, default=1, help='jobs of the process_folders run')
+    parser.add_argument('--startup', action='store_true', help='also time a new interpreter importing the scripts')
+    parser.add_argument('--report', default=REPORT_FILE)
+    parser.add_argument('--compare', help='an earlier report to compare the results with')
+    cli_args = parser.parse_args()
+
+    # Figures are drawn in this process, so that their cost shows up in their writers
+    results.configure_rendering(0)
+    results.CACHE_DIR = None
+
+    functions = [func_info for func_info in process_folders.FUNCTIONS if not cli_args.outputs or func_info['output_dir'] in cli_args.outputs]
+    roots = generate_records(cli_args.records_dir, cli_args.campaigns, cli_args.hosts, cli_args.experiments, cli_args.rounds, cli_args.na_ratio, cli_args.seed)
+    files = sorted(os.path.join(dirName, fname) for root_dir in roots for dirName, _, fileList in os.walk(root_dir) for fname in fileList if fname.endswith('.csv'))
+
+    output_dir = os.path.join(cli_args.records_dir, '_benchmark_outputs')
+    report = {
+        'environment': environment(),
+        'config': vars(cli_args),
+        'files': len(files),
+        'rows': sum(sum(1 for _ in open(file_path)) - 1 for file_path in files),
+        'stages': benchmark_stages(files, functions, output_dir, memory=not cli_args.no_memory)
+    }
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    if cli_args.pipeline:
+        report['pipeline'] = benchmark_pipeline(roots, functions, cli_args.jobs)
+
+    if cli_args.startup:
+        report['startup'] = benchmark_startup()
+        for module, startup in report['startup'].items():
+            print(f'import {module}: {startup["seconds"]:.3f} s, plotting modules loaded: {", ".join(startup["plotting_modules"]) or "none"}')
+
+    with open(cli_args.report, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Saved report to', cli_args.report)
+
+    stages_table = pd.DataFrame(report['stages']).T.sort_values('seconds', ascending=False)
+    print(stages_table.to_string())
+
+    if cli_args.compare:
+        with open(cli_args.compare) as f:
+            print(compare_reports(json.load(f), report).to_string(index=False))
+
+    sys.exit(1 if report.get('pipeline', {}).get('errors') else 0)
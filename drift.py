@@ -0,0 +1,180 @@
+import os
+import argparse
+import numpy as np
+from scipy.ndimage import maximum_filter1d
+
+import process_results as results
+import records_index
+import significance
+
+# Retrieval times over the Date of every record: rolling statistics and change points of every
+# series (the retrievals of one size by one host in one experiment, in date order), and the median
+# per hour of the day of every site. Kept next to significance.csv, outside the records tree.
+DRIFT_DIR = 'drift'
+
+SERIES_COLUMNS = ['Campaign', 'Backend', 'Operation', 'Experiment', 'Host', 'Size (Bytes)']
+
+def sort_series(data):
+    # One sort puts every series in date order, one after the other. Returns the sorted data, the
+    # series number of every row and the first and past-the-end row of the series of every row.
+    data = data.sort_values(SERIES_COLUMNS + ['Date'], kind='stable').reset_index(drop=True)
+    series = data.groupby(SERIES_COLUMNS, sort=False).ngroup().to_numpy()
+
+    bounds = np.r_[0, np.flatnonzero(np.diff(series)) + 1, len(series)]
+    starts = bounds[:-1][series]
+    ends = bounds[1:][series]
+
+    return data, series, starts, ends
+
+def window_moments(sums, squares, lower, upper):
+    # Count, mean and sample variance of the rows [lower, upper) from the cumulative sums
+    count = upper - lower
+    total = sums[upper] - sums[lower]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        variance = np.maximum(squares[upper] - squares[lower] - total * mean, 0) / (count - 1)
+
+    return count, mean, variance
+
+def cumulative_sums(values, series):
+    # Values centred on the mean of their series, so the sums of squares don't lose precision
+    means = np.bincount(series, values) / np.bincount(series)
+    centred = values - means[series]
+
+    return means[series], np.r_[0, np.cumsum(centred)], np.r_[0, np.cumsum(centred * centred)]
+
+def rolling_statistics(data, window=5, threshold=3.0, min_periods=3, column='Retrieval Time (ms)'):
+    # For every record the mean and std of the last window retrievals of its series, and the change
+    # score between the window before it and the window starting at it: Welch's t of the log times,
+    # which keeps a single slow retrieval from looking like a change. Records whose score reaches the
+    # threshold and is the largest within window records of them are flagged as change points.
+    data, series, starts, ends = sort_series(data)
+    positions = np.arange(len(data))
+    values = data[column].to_numpy(dtype=float)
+
+    means, sums, squares = cumulative_sums(values, series)
+    count, mean, variance = window_moments(sums, squares, np.maximum(starts, positions - window + 1), positions + 1)
+    data['Rolling mean'] = np.where(count >= min_periods, mean + means, np.nan)
+    data['Rolling std'] = np.where(count >= min_periods, np.sqrt(variance), np.nan)
+
+    _, sums, squares = cumulative_sums(np.log(np.maximum(values, np.finfo(float).tiny)), series)
+    count_before, mean_before, variance_before = window_moments(sums, squares, np.maximum(starts, positions - window), positions)
+    count_after, mean_after, variance_after = window_moments(sums, squares, positions, np.minimum(ends, positions + window))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = (mean_after - mean_before) / np.sqrt(variance_before / count_before + variance_after / count_after)
+    valid = (count_before >= min_periods) & (count_after >= min_periods) & np.isfinite(score)
+    score = np.where(valid, score, np.nan)
+    data['Change score'] = score
+
+    # Local maxima within each series: window empty slots between the series keep them apart
+    strength = np.zeros(len(data) + (series[-1] + 1) * window if len(data) else 0)
+    slots = positions + series * window
+    strength[slots] = np.where(valid, np.abs(score), 0)
+    peaks = maximum_filter1d(strength, 2 * window + 1, mode='constant')[slots] if len(data) else strength
+    data['Change point'] = valid & (np.abs(score) >= threshold) & (strength[slots] >= peaks)
+
+    return data
+
+def change_points(data):
+    # The flagged records, with their change score
+    points = data[data['Change point']].copy()
+    points.insert(0, 'Size', points.pop('Size (Bytes)').map(results.bytes_to_size))
+
+    return points
+
+def time_of_day(data, column='Retrieval Time (ms)'):
+    # Median per hour of the day, backend, site and size, and relative to the median of the whole day
+    hours = data['Date'].dt.hour.rename('Hour')
+    keys = [data['Backend'], data['Site'], data['Size (Bytes)']]
+
+    table = data.groupby(keys + [hours], sort=True)[column].agg(['median', 'size'])
+    day_medians = data.groupby(keys, sort=True)[column].median()
+    table['Relative median'] = table['median'] / day_medians.reindex(table.index.droplevel('Hour')).to_numpy()
+    table = table.rename(columns={'median': 'Median', 'size': 'Count'}).reset_index()
+
+    table.insert(2, 'Size', table.pop('Size (Bytes)').map(results.bytes_to_size))
+    return table
+
+def timeline_figure(data, title, column='Retrieval Time (ms)'):
+    # One panel per size: the retrievals of every host, their rolling mean and the change points
+    import matplotlib.pyplot as plt
+
+    sizes = sorted(data['Size (Bytes)'].unique())
+    columns = min(4, max(1, len(sizes)))
+    rows = max(1, -(-len(sizes) // columns))
+    fig, axes = plt.subplots(rows, columns, figsize=(5 * columns, 3.5 * rows), squeeze=False)
+
+    for ax, (size, size_data) in zip(axes.flat, data.groupby('Size (Bytes)', sort=True)):
+        for i, (host, host_data) in enumerate(size_data.groupby('Host', sort=True)):
+            color = f'C{i % 10}'
+            ax.scatter(host_data['Date'], host_data[column], s=6, alpha=0.3, color=color)
+            ax.plot(host_data['Date'], host_data['Rolling mean'], color=color, label=host)
+
+            points = host_data[host_data['Change point']]
+            ax.scatter(points['Date'], points['Rolling mean'], marker='x', s=40, color='red', zorder=3)
+
+        ax.set_title(results.bytes_to_size(size))
+        ax.set_ylabel(column)
+        ax.set_yscale('log')
+        ax.tick_params(axis='x', labelrotation=30, labelsize=7)
+
+    for ax in axes.flat[len(sizes):]:
+        ax.set_visible(False)
+
+    axes.flat[0].legend(fontsize=7)
+    fig.suptitle(title)
+    fig.tight_layout()
+    return fig
+
+def plot_timelines(data, directory=DRIFT_DIR):
+    # A figure per campaign, backend, operation and experiment, drawn by the render pool
+    directory = os.path.join(directory, 'timelines')
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    columns = ['Date', 'Host', 'Size (Bytes)', 'Retrieval Time (ms)', 'Rolling mean', 'Change point']
+    for (campaign, backend, operation, experiment), experiment_data in data.groupby(SERIES_COLUMNS[:4], sort=True):
+        title = f'{campaign} {backend} {operation} {experiment}'
+        file_name = '_'.join(part.replace('/', '-').replace(' ', '') for part in [campaign, backend, operation, experiment])
+
+        results.submit_render(results.FigurePlot(None, timeline_figure, (experiment_data[columns], title)), os.path.join(directory, f'{file_name}.png'))
+        paths.append(os.path.join(directory, f'{file_name}.png'))
+
+    results.finish_rendering()
+    return paths
+
+def analyse_drift(window=5, threshold=3.0, plots=True, directory=DRIFT_DIR, **criteria):
+    index = records_index.update_index()
+    data = significance.load_records(records_index.select_files(index, **criteria), extra_columns=['Date'])
+    data = rolling_statistics(data, window, threshold)
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, table in [('drift', data), ('change_points', change_points(data)), ('time_of_day', time_of_day(data))]:
+        table.to_csv(os.path.join(directory, f'{name}.csv'), index=False, date_format=results.DATE_FORMAT)
+        paths.append(os.path.join(directory, f'{name}.csv'))
+
+    if plots:
+        paths += plot_timelines(data, directory)
+
+    return data, paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rolling statistics, change points and time lines of the retrieval times over the dates of the records')
+    parser.add_argument('--window', type=int, default=5, help='retrievals in the rolling windows')
+    parser.add_argument('--threshold', type=float, default=3.0, help='change score (Welch t of the log times) flagging a change point')
+    parser.add_argument('--no-plots', action='store_true', help='only write the tables')
+    parser.add_argument('--render-workers', type=int, default=0, help='processes drawing the time lines, 0 to draw them serially')
+    for tag in ['campaign', 'backend', 'operation', 'experiment', 'host', 'site']:
+        parser.add_argument(f'--{tag}', action='append')
+    cli_args = parser.parse_args()
+    results.configure_rendering(cli_args.render_workers)
+
+    criteria = {tag: values for tag, values in vars(cli_args).items() if values and tag in ['campaign', 'backend', 'operation', 'experiment', 'host', 'site']}
+    criteria.setdefault('operation', 'retrieve')
+
+    data, paths = analyse_drift(cli_args.window, cli_args.threshold, not cli_args.no_plots, **criteria)
+    print(f'{int(data["Change point"].sum())} change points in {len(data)} records, saved {len(paths)} files to {DRIFT_DIR}')
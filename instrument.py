@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Opt-in spans around the stages, output writers and directories of a run. Every span records
+# its wall time, CPU time, the growth of the peak RSS and the rows/groups it produced. Disabled,
+# call() is a plain function call and span() a no-op.
+ENABLED = bool(os.environ.get('INSTRUMENT'))
+
+events = []
+origin = time.perf_counter()
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def max_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def value_size(value):
+    # (rows, groups) of a stage result
+    if isinstance(value, tuple) and 'data' in getattr(value, '_fields', ()):
+        value = value.data
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value), None
+    if hasattr(value, 'ngroups') and hasattr(value, 'obj'):
+        return len(value.obj), value.ngroups
+    if isinstance(value, list):
+        return len(value), None
+
+    return None, None
+
+def record(name, category, start, wall, cpu, rss_delta, value=None, **args):
+    rows, groups = value_size(value)
+    events.append({
+        'name': name,
+        'category': category,
+        'start': start,
+        'wall': wall,
+        'cpu': cpu,
+        'rss_delta': rss_delta,
+        'rows': rows,
+        'groups': groups,
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': args
+    })
+
+def call(name, category, function, *args, **kwargs):
+    # CPU time of the calling thread only, stages may run in several threads at once
+    if not ENABLED:
+        return function(*args, **kwargs)
+
+    start, cpu, rss = time.perf_counter(), time.thread_time(), max_rss()
+    value = function(*args, **kwargs)
+    record(name, category, start - origin, time.perf_counter() - start, time.thread_time() - cpu, max_rss() - rss, value)
+
+    return value
+
+@contextmanager
+def span(name, category, **args):
+    # CPU time of the whole process, including the threads running stages within the span
+    if not ENABLED:
+        yield
+        return
+
+    start, cpu, rss = time.perf_counter(), time.process_time(), max_rss()
+    try:
+        yield
+    finally:
+        record(name, category, start - origin, time.perf_counter() - start, time.process_time() - cpu, max_rss() - rss, **args)
+
+def take_events():
+    # Hand the events of a worker process over to the parent
+    taken = events[:]
+    del events[:]
+    return taken
+
+def add_events(new_events):
+    events.extend(new_events)
+
+def summary():
+    # Totals per (category, name)
+    if not events:
+        return []
+
+    data = pd.DataFrame(events)
+    totals = data.groupby(['category', 'name'], sort=False).agg(
+        calls=('wall', 'size'),
+        wall=('wall', 'sum'),
+        cpu=('cpu', 'sum'),
+        rss_delta=('rss_delta', 'max'),
+        rows=('rows', lambda values: values.sum(min_count=1)),
+        groups=('groups', lambda values: values.sum(min_count=1))
+    )
+    totals = totals.sort_values('wall', ascending=False).reset_index()
+
+    # Spans without rows or groups (directories, figures...) get null rather than NaN, which isn't valid JSON
+    return totals.astype(object).where(totals.notna(), None).to_dict('records')
+
+def chrome_trace():
+    # Complete ('X') events of the trace event format, viewable in chrome://tracing or Perfetto
+    trace_events = []
+    for event in events:
+        args = {key: event[key] for key in ['cpu', 'rss_delta', 'rows', 'groups'] if event[key] is not None}
+        args.update(event['args'])
+
+        trace_events.append({
+            'name': event['name'],
+            'cat': event['category'],
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['wall'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': args
+        })
+
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+def save(prefix):
+    # Writes <prefix>.json with the totals and every event, and <prefix>.trace.json
+    with open(f'{prefix}.json', 'w') as f:
+        json.dump({'summary': summary(), 'events': events}, f, indent=1, default=str)
+
+    with open(f'{prefix}.trace.json', 'w') as f:
+        json.dump(chrome_trace(), f, default=str)
+
+    return [f'{prefix}.json', f'{prefix}.trace.json']
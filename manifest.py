@@ -0,0 +1,153 @@
+import os
+import sys
+import ast
+import dis
+import json
+import hashlib
+import inspect
+import functools
+
+# Each processed tree keeps a manifest at its root. For every output (output_dir/name) it records
+# the input CSVs and the function spec it was derived from, plus the files that were written.
+MANIFEST_FILE = 'manifest.json'
+
+def load_manifest(directory):
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest, directory):
+    os.makedirs(directory, exist_ok=True)
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+
+    tmp_file = f'{manifest_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+# Code of this repository, whose functions can change between two runs (unlike the libraries')
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def local(value):
+    module = value if inspect.ismodule(value) else sys.modules.get(getattr(value, '__module__', None))
+    file_path = getattr(module, '__file__', None)
+    return file_path is not None and os.path.dirname(os.path.abspath(file_path)) == SOURCE_DIR
+
+@functools.lru_cache(maxsize=None)
+def assignments(file_path):
+    # {name: source of the statements assigning it} of the module level of a source file, which
+    # unlike the values doesn't depend on the configuration or the state of the run
+    with open(file_path) as f:
+        source = f.read()
+
+    statements = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        statements[name.id] = statements.get(name.id, '') + ast.get_source_segment(source, node)
+
+    return statements
+
+def code_names(code):
+    # The global names and the attribute names the code loads, nested functions and lambdas included
+    global_names, attributes = set(), set()
+    for instruction in dis.get_instructions(code):
+        if instruction.opname in ['LOAD_GLOBAL', 'LOAD_NAME']:
+            global_names.add(instruction.argval)
+        elif instruction.opname in ['LOAD_ATTR', 'LOAD_METHOD']:
+            attributes.add(instruction.argval)
+
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            nested_globals, nested_attributes = code_names(constant)
+            global_names |= nested_globals
+            attributes |= nested_attributes
+
+    return global_names, attributes
+
+def dependencies(function):
+    # The functions of this repository the function refers to, either directly (find_measures) or as
+    # attributes of a module of this repository (outliers.gates), and the module level assignments of
+    # the other globals it uses (MEASURES_COLUMNS)
+    global_names, attributes = code_names(function.__code__)
+    module_assignments = assignments(function.__code__.co_filename) if local(function) else {}
+    functions, statements = [], {}
+
+    for name in sorted(global_names):
+        value = function.__globals__.get(name)
+
+        if inspect.ismodule(value) and local(value):
+            functions += [getattr(value, attribute) for attribute in sorted(attributes) if inspect.isfunction(getattr(value, attribute, None))]
+        elif inspect.isfunction(value):
+            functions.append(value)
+        elif name in module_assignments:
+            statements[name] = module_assignments[name]
+
+    return [dependency for dependency in functions if local(dependency)], statements
+
+@functools.lru_cache(maxsize=None)
+def source_hash(value):
+    # Hash the source of the function and of everything of this repository it uses, recursively,
+    # so that changing a helper it calls counts but editing unrelated code doesn't
+    sources = {}
+    pending = [value]
+
+    while pending:
+        function = pending.pop()
+        # By file rather than module name, which is __main__ in the script that was run
+        module = sys.modules.get(getattr(function, '__module__', None))
+        key = f'{os.path.basename(getattr(module, "__file__", None) or "")}:{function.__qualname__}'
+        if key in sources:
+            continue
+
+        try:
+            sources[key] = inspect.getsource(function)
+        except (TypeError, OSError):
+            sources[key] = function.__qualname__
+
+        if inspect.isfunction(function):
+            functions, statements = dependencies(function)
+            sources[key] += repr(sorted(statements.items()))
+            pending += functions
+
+    return hashlib.sha1(repr(sorted(sources.items())).encode()).hexdigest()
+
+def spec_signature(func_info):
+    spec = {}
+
+    for key, value in sorted(func_info.items()):
+        if callable(value):
+            spec[key] = f'{value.__qualname__}:{source_hash(value)}'
+        else:
+            spec[key] = repr(value)
+
+    return spec
+
+def inputs_signature(fingerprints):
+    # fingerprints: {file_path: [abspath, size, mtime_ns]} as returned by results.file_fingerprint
+    return {os.path.normpath(file_path): fingerprint[1:] for file_path, fingerprint in sorted(fingerprints.items())}
+
+def output_key(manifest_dir, output_dir, name):
+    return os.path.relpath(os.path.join(output_dir, name), manifest_dir)
+
+def is_up_to_date(manifest, manifest_dir, key, inputs, spec):
+    entry = manifest.get(key)
+    if entry is None or entry['inputs'] != inputs or entry['spec'] != spec:
+        return False
+
+    # Regenerate outputs that have been deleted since
+    return all(os.path.exists(os.path.join(manifest_dir, path)) for path in entry['outputs'])
+
+def record(manifest, manifest_dir, key, inputs, spec, outputs):
+    manifest[key] = {
+        'inputs': inputs,
+        'spec': spec,
+        'outputs': [os.path.relpath(path, manifest_dir) for path in outputs or []]
+    }
@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+# Outlier detection methods, every one a pair of gates per group: values below the lower or above
+# the upper gate of their group are outliers. A method is given as 'name' or 'name:param=value,...':
+#   iqr:k=1.5                    Tukey's fences, Q1 - k IQR and Q3 + k IQR
+#   mad:z=3.5                    modified z-score 0.6745 |x - median| / MAD above z
+#   percentile:low=1,high=99     the values below/above these percentiles of their group
+#   cutoff:low=0,high=15000      absolute limits, either one optional
+# All the methods asked for are computed from the same sort of the values of every group.
+METHODS = {
+    'iqr': {'k': 1.5},
+    'mad': {'z': 3.5},
+    'percentile': {'low': 1.0, 'high': 99.0},
+    'cutoff': {'low': -np.inf, 'high': np.inf}
+}
+
+DEFAULT_METHODS = ['iqr:k=1.5', 'iqr:k=3', 'mad:z=3.5', 'percentile:low=1,high=99', 'cutoff:high=15000']
+
+# The values of every group sorted, one group after the other. order maps the sorted values back
+# to their rows (positions in data.obj), starts/ends are the bounds of every group.
+SortedGroups = namedtuple('SortedGroups', ['values', 'order', 'codes', 'starts', 'ends'])
+
+def parse_method(method):
+    # 'mad:z=3' -> ('mad', {'z': 3.0})
+    name, _, params = method.partition(':')
+    if name not in METHODS:
+        raise ValueError(f'Unknown outlier method {name}, expected one of {", ".join(METHODS)}')
+
+    values = dict(METHODS[name])
+    for param in filter(None, params.split(',')):
+        key, _, value = param.partition('=')
+        if key not in values:
+            raise ValueError(f'Unknown parameter {key} of outlier method {name}')
+        values[key] = float(value)
+
+    return name, values
+
+def sort_groups(data, column='Retrieval Time (ms)'):
+    # The one sort: rows by group, then by value
+    codes = data.ngroup().to_numpy()
+    values = data.obj[column].to_numpy(dtype=float)
+
+    order = np.flatnonzero((codes >= 0) & ~np.isnan(values))
+    order = order[np.lexsort((values[order], codes[order]))]
+
+    counts = np.bincount(codes[order], minlength=data.ngroups)
+    ends = np.cumsum(counts)
+
+    return SortedGroups(values[order], order, codes[order], ends - counts, ends)
+
+def quantiles(groups, q):
+    # Quantile q of every group from the sorted values, interpolated linearly like pandas and numpy
+    sizes = groups.ends - groups.starts
+    position = (sizes - 1) * q
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, sizes - 1)
+
+    valid = sizes > 0
+    first = np.where(valid, groups.starts + lower, 0)
+    last = np.where(valid, groups.starts + upper, 0)
+    low, high = groups.values[first], groups.values[last]
+
+    return np.where(valid, low + (high - low) * (position - lower), np.nan)
+
+def search_groups(array, targets, starts, ends, side='left'):
+    # np.searchsorted of every target within its own ascending [start, end) of the array,
+    # as a binary search over all of them at once
+    low, high = starts.copy(), ends.copy()
+
+    while True:
+        active = low < high
+        if not active.any():
+            return low
+
+        middle = (low + high) // 2
+        values = array[np.where(active, middle, 0)]
+        right = (values < targets) if side == 'left' else (values <= targets)
+
+        low = np.where(active & right, middle + 1, low)
+        high = np.where(active & ~right, middle, high)
+
+def median_deviations(groups, medians):
+    # Median absolute deviation of every group without sorting the deviations. Along the sorted values
+    # the deviations decrease below the median and increase above it, so the rank of a deviation within
+    # its group is its rank on its own side plus the number of smaller ones on the other side. The
+    # comparisons are all made on x - median, so ties between the two sides are ranked consistently.
+    rows = np.arange(len(groups.values))
+    starts, ends = groups.starts[groups.codes], groups.ends[groups.codes]
+    shifted = groups.values - medians[groups.codes]
+    split = search_groups(groups.values, medians, groups.starts, groups.ends)[groups.codes]
+
+    lower_side = rows < split
+    deviations = np.abs(shifted)
+
+    # Deviations above the median at most as large, for the rows below it, and smaller ones
+    # below the median (shifted > -deviation), for the rows above it
+    own_rank = np.where(lower_side, split - 1 - rows, rows - split)
+    other_rank = np.where(
+        lower_side,
+        search_groups(shifted, deviations, split, ends, side='right') - split,
+        split - search_groups(shifted, -deviations, starts, split, side='right')
+    )
+
+    merged = np.empty_like(deviations)
+    merged[starts + own_rank + other_rank] = deviations
+
+    return quantiles(groups._replace(values=merged), 0.5)
+
+def gates(groups, method):
+    # (lower, upper) gates of every group for the method
+    name, params = parse_method(method)
+
+    if name == 'iqr':
+        q1, q3 = quantiles(groups, 0.25), quantiles(groups, 0.75)
+        step = params['k'] * (q3 - q1)
+        return q1 - step, q3 + step
+
+    if name == 'mad':
+        medians = quantiles(groups, 0.5)
+        # |x - median| <= z MAD / 0.6745, a MAD of 0 leaves only the values equal to the median
+        step = params['z'] * median_deviations(groups, medians) / 0.6745
+        return medians - step, medians + step
+
+    if name == 'percentile':
+        return quantiles(groups, params['low'] / 100), quantiles(groups, params['high'] / 100)
+
+    count = len(groups.starts)
+    return np.full(count, params['low']), np.full(count, params['high'])
+
+def outlier_flags(data, column='Retrieval Time (ms)', methods=DEFAULT_METHODS):
+    # Per-row flags of every method (a column each, indexed like data.obj, False for ungrouped rows)
+    # and the gates of every group and method
+    groups = sort_groups(data, column)
+    flags = {}
+    group_gates = {}
+
+    for method in methods:
+        lower, upper = gates(groups, method)
+        outliers = (groups.values < lower[groups.codes]) | (groups.values > upper[groups.codes])
+
+        row_flags = np.zeros(len(data.obj), dtype=bool)
+        row_flags[groups.order] = outliers
+        flags[method] = row_flags
+        group_gates[method] = (lower, upper)
+
+    return pd.DataFrame(flags, index=data.obj.index), group_gates, groups
@@ -0,0 +1,223 @@
+import os
+import glob
+import time
+import pickle
+import argparse
+from urllib.parse import quote, unquote
+import pandas as pd
+
+# Tabular outputs can be collected into one dataset per output (measures, outliers...) instead of a
+# CSV or txt file per scope. Every output is partitioned by processed tree, e.g.
+# 13-06 & 18-06/swarm/retrieve_processed_by_client, which is also what a single job writes, so jobs
+# never write to the same partition. Writes are buffered and every flush adds one segment (a pickled
+# DataFrame of all the outputs written since) to each partition, atomically. Readers merge the
+# segments, newer outputs replacing older ones, and compact() folds a partition into one segment.
+STORE_DIR = os.environ.get('OUTPUT_STORE_DIR', './accumulated_csv_records/_processed_store')
+RECORDS_DIR = './accumulated_csv_records'
+
+KEY_COLUMNS = ['Store group', 'Store name']
+METADATA_COLUMNS = ['Campaign', 'Backend', 'Operation', 'Scope', 'Experiment', 'Client']
+
+SCOPES = {
+    '': 'all',
+    '_by_experiment': 'experiment',
+    '_by_client': 'client',
+    '_by_experiment_and_client': 'experiment_and_client'
+}
+
+# {(output, tree): {'format', 'segment', 'frames', 'columns'}} written since the last flush
+pending = {}
+
+def locate(directory, records_dir=RECORDS_DIR):
+    # output_dir of the per-file layout -> (output, processed tree, group within the tree)
+    parts = os.path.relpath(directory, records_dir).split(os.sep)
+
+    for i, part in enumerate(parts[:-1]):
+        if '_processed' in part:
+            return parts[-1], '/'.join(parts[:i + 1]), '/'.join(parts[i + 1:-1])
+
+    return parts[-1], '/'.join(parts[:-1]), ''
+
+def metadata(tree, group, name):
+    # Campaign/Backend/Operation of the tree, and the experiment or client the output is about
+    *campaign, backend, processed = ['', ''] + tree.split('/')
+    operation, _, suffix = processed.partition('_processed')
+    scope = SCOPES.get(suffix)
+
+    return {
+        'Campaign': '/'.join(part for part in campaign if part),
+        'Backend': backend,
+        'Operation': operation,
+        'Scope': scope,
+        'Experiment': group if scope == 'experiment_and_client' else name if scope == 'experiment' else None,
+        'Client': name if scope in ['client', 'experiment_and_client'] else None
+    }
+
+def partition_dir(output, tree, store_dir=STORE_DIR):
+    return os.path.join(store_dir, output, quote(tree, safe=' &-_.'))
+
+def pending_partition(output, tree, output_format=None):
+    partition = pending.setdefault((output, tree), {
+        'format': output_format,
+        'segment': f'part-{time.time_ns()}-{os.getpid()}.pkl',
+        'frames': [],
+        'columns': {}
+    })
+    partition['format'] = partition['format'] or output_format
+
+    return partition
+
+def add(output_format, data, directory, name):
+    # Buffer the output that would be written in directory as name, returns the segment it will be flushed to
+    output, tree, group = locate(directory)
+
+    if output_format == 'txt':
+        data = pd.DataFrame({'Line': [', '.join(map(str, row)) for row in data]})
+
+    partition = pending_partition(output, tree, output_format)
+    partition['columns'][(group, name)] = data.dtypes.astype(str).to_dict()
+
+    frame = data.reset_index(drop=True)
+    frame.insert(0, 'Store group', group)
+    frame.insert(1, 'Store name', name)
+    partition['frames'].append(frame)
+
+    return [os.path.join(partition_dir(output, tree), partition['segment'])]
+
+def discard(directory, name):
+    # Remove the output that was written in directory as name: the next segment records it
+    # without columns, which hides it in the older segments
+    output, tree, group = locate(directory)
+    pending_partition(output, tree)['columns'][(group, name)] = None
+
+def write_atomic(path, value):
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, path)
+
+def flush():
+    segments = []
+
+    for (output, tree), partition in pending.items():
+        directory = partition_dir(output, tree)
+        os.makedirs(directory, exist_ok=True)
+
+        segment = os.path.join(directory, partition['segment'])
+        write_atomic(segment, {
+            'format': partition['format'],
+            'columns': partition['columns'],
+            'data': pd.concat(partition['frames'], ignore_index=True) if partition['frames'] else pd.DataFrame(columns=KEY_COLUMNS)
+        })
+        segments.append(segment)
+
+    pending.clear()
+    return segments
+
+def segments(directory):
+    # Oldest first, the names start with the time they were created at
+    return sorted(glob.glob(os.path.join(glob.escape(directory), 'part-*.pkl')))
+
+def read_partition(directory):
+    # The outputs of a partition, each from the newest segment it is in
+    output_format = None
+    frames = []
+    columns = {}
+
+    for segment in reversed(segments(directory)):
+        with open(segment, 'rb') as f:
+            content = pickle.load(f)
+        output_format = output_format or content['format']
+
+        keys = set(content['columns']) - set(columns)
+        if not keys:
+            continue
+
+        data = content['data']
+        frames.append(data[[key in keys for key in zip(data['Store group'], data['Store name'])]])
+        columns.update({key: content['columns'][key] for key in keys})
+
+    # Discarded outputs have no rows left
+    columns = {key: dtypes for key, dtypes in columns.items() if dtypes is not None}
+
+    data = pd.concat(frames[::-1], ignore_index=True) if frames else pd.DataFrame(columns=KEY_COLUMNS)
+    return output_format, columns, data
+
+def partitions(output=None, store_dir=STORE_DIR):
+    # (output, tree, directory) of every partition
+    for output_dir in sorted(os.listdir(store_dir)) if os.path.isdir(store_dir) else []:
+        if output is not None and output_dir != output:
+            continue
+
+        for tree in sorted(os.listdir(os.path.join(store_dir, output_dir))):
+            yield output_dir, unquote(tree), os.path.join(store_dir, output_dir, tree)
+
+def load(output, store_dir=STORE_DIR, **filters):
+    # Every row of an output, e.g. load('measures', backend='swarm', scope='client'), with the
+    # campaign, backend, operation, scope, experiment and client it belongs to
+    frames = []
+
+    for _, tree, directory in partitions(output, store_dir):
+        _, _, data = read_partition(directory)
+
+        tags = pd.DataFrame([metadata(tree, group, name) for group, name in zip(data['Store group'], data['Store name'])], columns=METADATA_COLUMNS, index=data.index)
+        data = pd.concat([tags, data], axis=1)
+
+        for column, value in filters.items():
+            data = data[data[column.capitalize()] == value]
+        frames.append(data)
+
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=METADATA_COLUMNS + KEY_COLUMNS)
+
+def compact(store_dir=STORE_DIR):
+    # Fold every partition into its newest segment. Manifests pointing to the older segments
+    # no longer find them, so the next incremental run recomputes those outputs.
+    for _, _, directory in partitions(store_dir=store_dir):
+        old_segments = segments(directory)
+        if len(old_segments) < 2:
+            continue
+
+        output_format, columns, data = read_partition(directory)
+        write_atomic(old_segments[-1], {'format': output_format, 'columns': columns, 'data': data})
+
+        for segment in old_segments[:-1]:
+            os.remove(segment)
+
+def export(writers, store_dir=STORE_DIR, records_dir=RECORDS_DIR):
+    # Write every output back in the per-file layout, with writers = {'csv': save_csv, 'txt': write_to_txt}
+    paths = []
+
+    for output, tree, directory in partitions(store_dir=store_dir):
+        output_format, columns, data = read_partition(directory)
+
+        for (group, name), rows in data.groupby(KEY_COLUMNS, sort=False):
+            dtypes = columns[(group, name)]
+            rows = rows[list(dtypes)].astype(dtypes).reset_index(drop=True)
+
+            if output_format == 'txt':
+                rows = [[line] for line in rows['Line']]
+
+            paths += writers[output_format](rows, os.path.join(records_dir, tree, group, output), name)
+
+    return paths
+
+
+if __name__ == "__main__":
+    import process_results as results
+
+    parser = argparse.ArgumentParser(description='Manage the consolidated output store')
+    parser.add_argument('command', choices=['export', 'compact', 'show'])
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--records-dir', default=RECORDS_DIR, help='where export writes the per-file layout')
+    parser.add_argument('--output', help='output to show, e.g. measures')
+    cli_args = parser.parse_args()
+
+    if cli_args.command == 'export':
+        paths = export({'csv': results.save_csv, 'txt': results.write_to_txt}, cli_args.store_dir, cli_args.records_dir)
+        print(f'Exported {len(paths)} files')
+    elif cli_args.command == 'compact':
+        compact(cli_args.store_dir)
+    else:
+        for output, tree, directory in partitions(cli_args.output, cli_args.store_dir):
+            _, columns, data = read_partition(directory)
+            print(f'{output} {tree}: {len(columns)} outputs, {len(data)} rows, {len(segments(directory))} segments')
@@ -1,7 +1,25 @@
 import os
+import sys
+import logging
+import argparse
+import itertools
+import traceback
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import process_results as results
+import manifest
+import stages
+import records_index
+import instrument
+import output_store
+import record_store
+import sketches
+
+logger = logging.getLogger(__name__)
+
+TAG_COLUMNS = ['Experiment', 'Client', 'File']
 
 def groupby(data, groupby='Size (Bytes)', groupby_type=int):
     # Convert column to desired type
@@ -27,167 +45,332 @@ def na_ratio(data, column='Retrieval Time (ms)'):
 
     return results
 
-def process_experiments(root_dir, column, functions):
-    for dirName, subdirList, fileList in os.walk(root_dir):
-        print('Found directory:', dirName)
-        found_csv_foler = False
-        all_data = pd.DataFrame()
+def find_client(fname):
+    # The client is the site of the host that recorded the file (lille, nancy, degroot...)
+    _, site = records_index.parse_host(fname)
+    return site
+
+# The column summarized per file and size when ingesting, see summarize_file
+SUMMARY_COLUMN = 'Retrieval Time (ms)'
+
+def summarize_file(data, column=SUMMARY_COLUMN):
+    # {size: Summary} of the rows of a file the scopes keep, i.e. without NAs
+    data = data.dropna()
+    return sketches.summarize_groups(data.groupby(data['Size (Bytes)'].astype(int)), column)
+
+def ingest_store(files):
+    # The records of the files gathered from the record store in one go, None if any of them isn't stored
+    stored = record_store.read_files([file_path for _, _, file_path in files])
+    if stored is None:
+        return None
+
+    records, entries = stored
+    lengths = [entry['Stop'] - entry['Start'] for entry in entries]
+    tags = {
+        'Experiment': [os.path.basename(dirName) for dirName, _, _ in files],
+        'Client': [find_client(fname) for _, fname, _ in files],
+        'File': [file_path for _, _, file_path in files]
+    }
+    for tag, values in tags.items():
+        # Object columns, like those of the concatenated files
+        records[tag] = np.repeat(np.array(values, dtype=object), lengths)
 
-        for fname in fileList:
-            if fname.endswith('.csv'):
-                print('\tProcessing file:', fname)
-                file_path = os.path.join(dirName, fname)
-                found_csv_foler = True
+    records.attrs['file_columns'] = {file_path: list(entry['Columns']) for (_, _, file_path), entry in zip(files, entries)}
+    records.attrs['file_fingerprints'] = {file_path: results.file_fingerprint(file_path) for _, _, file_path in files}
 
-                data = results.read_all(file_path, dropna=False)
-                all_data = pd.concat([all_data, data], ignore_index=True)
-                    
-        # Process the data only after all CSV files have been appended
-        if found_csv_foler:
-            for func_info in functions:
-                data = all_data.copy()
-
-                dropna = func_info.get('dropna', True)
-                if dropna:
-                    data.dropna(inplace=True)
-                
-                if 'data_load_function' in func_info:
-                    args = func_info['args']
-                    data_load_function = func_info['data_load_function']
-                    data = data_load_function(data, *args)
-                
-                function = func_info['function']
-
-                if 'data_process_function' in func_info:
-                    process_function = func_info['data_process_function']
-                    data = process_function(data)
-
-                data = function(data)
-
-                if 'output_function' in func_info:
-                    output_function = func_info['output_function']
-
-                    if 'output_dir' in func_info:
-                        output_dir = func_info['output_dir']
-                        parent_dir = os.path.dirname(dirName)
-                        grand_parent_dir = os.path.dirname(dirName)
-                        output_dir = os.path.join(os.path.dirname(parent_dir), os.path.basename(parent_dir) + '_processed_by_experiment', output_dir)
-
-                    output_function(data, output_dir, os.path.basename(dirName))
-
-            del subdirList[:]  # Prevent os.walk from descending into subdirectories
-
-def process_all(root_dir, column, functions):
-    all_data = pd.DataFrame()
+    starts = np.r_[0, np.cumsum(lengths)]
+    records.attrs['file_summaries'] = {file_path: summarize_file(records.iloc[start:stop][list(entry['Columns'])]) for (_, _, file_path), entry, start, stop in zip(files, entries, starts, starts[1:])}
 
-    for dirName, subdirList, fileList in os.walk(root_dir):
-        print('Found directory:', dirName)
-        found_csv_foler = False
+    return records
 
+def csv_files(root_dir):
+    # (directory, file name, path) of every CSV under root_dir, as the walk finds them
+    for dirName, subdirList, fileList in os.walk(root_dir):
         for fname in fileList:
             if fname.endswith('.csv'):
-                print('\tProcessing file:', fname)
-                file_path = os.path.join(dirName, fname)
-                found_csv_foler = True
-
+                yield dirName, fname, os.path.join(dirName, fname)
+
+def ingest(root_dir, errors=None):
+    # Read every CSV under root_dir exactly once and tag each row with the experiment
+    # (csv folder), the client (matched from the file name) and the file it came from.
+    # If an errors list is given, unreadable files are skipped and reported there.
+    files = csv_files(root_dir)
+
+    if record_store.ENABLED:
+        files = list(files)
+        if files:
+            records = ingest_store(files)
+            if records is not None:
+                logger.info('Read the %d files of %s from the record store', len(files), root_dir)
+                return records
+            logger.warning('\tSome files of %s are not in the record store, reading their CSVs', root_dir)
+
+    frames = []
+    file_columns = {}
+    file_fingerprints = {}
+    file_summaries = {}
+
+    # The files are read ahead by the read pool while the walk goes on, and concatenated in walk order
+    for dirName, group in itertools.groupby(results.read_ahead(files, key=lambda file: file[2]), key=lambda file: file[0]):
+        logger.info('Found directory: %s', dirName)
+
+        for _, fname, file_path in group:
+            logger.info('\tProcessing file: %s', fname)
+            try:
+                file_fingerprints[file_path] = results.file_fingerprint(file_path)
                 data = results.read_all(file_path, dropna=False)
-                all_data = pd.concat([all_data, data], ignore_index=True)
-                    
-    # Process the data only after all CSV files have been appended
-    if found_csv_foler:
-        for func_info in functions:
-            data = all_data.copy()
-
-            dropna = func_info.get('dropna', True)
-            if dropna:
-                data.dropna(inplace=True)
-            
-            if 'data_load_function' in func_info:
-                args = func_info['args']
-                data_load_function = func_info['data_load_function']
-                data = data_load_function(data, *args)
-            
-            function = func_info['function']
+            except (OSError, ValueError) as e:
+                if errors is None:
+                    raise
+
+                logger.warning('\tSkipping file: %s %s', fname, e)
+                errors.append(f'{file_path}: {type(e).__name__}: {e}')
+                continue
+
+            file_columns[file_path] = list(data.columns)
+            file_summaries[file_path] = summarize_file(data)
+            data['Experiment'] = os.path.basename(dirName)
+            data['Client'] = find_client(fname)
+            data['File'] = file_path
+            frames.append(data)
+
+    if not frames:
+        return pd.DataFrame(columns=TAG_COLUMNS)
+
+    records = pd.concat(frames, ignore_index=True)
+    records.attrs['file_columns'] = file_columns
+    records.attrs['file_fingerprints'] = file_fingerprints
+    records.attrs['file_summaries'] = file_summaries
+
+    return records
+
+def tags_mask(records, **tags):
+    mask = pd.Series(True, index=records.index)
+    for tag, value in tags.items():
+        mask &= records[tag.capitalize()] == value
+
+    return mask
+
+def select(records, **tags):
+    # Rows of the ingested records matching the given tags, without the tag columns
+    # and re-indexed as if the matching files had been concatenated on their own
+    mask = tags_mask(records, **tags)
+
+    # Keep only the columns the selected files actually have, like a plain concat would
+    files = records.loc[mask, 'File'].unique()
+    columns = []
+    for file_path in files:
+        columns += [column for column in records.attrs['file_columns'][file_path] if column not in columns]
+
+    data = records.loc[mask, columns].reset_index(drop=True)
+
+    # The statistics and outlier gates of every size over the selected files, merged from their
+    # summaries instead of computed from the rows again, see results.split_outliers. They are kept
+    # as plain tuples: pandas compares the attrs of the frames it concatenates, which a frame can't do.
+    data.attrs = {}
+    if 'file_summaries' in records.attrs:
+        summaries = sketches.merge_groups([records.attrs['file_summaries'][file_path] for file_path in files])
+        stats = sketches.statistics_frame(summaries)
+        data.attrs['group_statistics'] = (SUMMARY_COLUMN, tuple(stats.index), tuple((name, tuple(values.tolist())) for name, values in stats.items()))
+
+    return data
+
+def select_inputs(records, **tags):
+    # Fingerprints of the files the rows matching the given tags were read from
+    files = records.loc[tags_mask(records, **tags), 'File'].unique()
+    return manifest.inputs_signature({file_path: records.attrs['file_fingerprints'][file_path] for file_path in files})
+
+def apply_functions(all_data, functions, output_dir_root, name, inputs=None):
+    # When the inputs are given, outputs whose inputs and spec match the manifest are not recomputed
+    incremental = inputs is not None
+    if incremental:
+        outputs_manifest = manifest.load_manifest(output_dir_root)
+
+    pending = []
+    for func_info in functions:
+        key = spec = None
+
+        if incremental and 'output_dir' in func_info:
+            key = manifest.output_key(output_dir_root, os.path.join(output_dir_root, func_info['output_dir']), name)
+            spec = manifest.spec_signature(func_info)
+
+            if manifest.is_up_to_date(outputs_manifest, output_dir_root, key, inputs, spec):
+                logger.info('\tUp to date: %s', key)
+                continue
+
+        pending.append((func_info, key, spec))
+
+    def output(index, data):
+        func_info, key, spec = pending[index]
+
+        if 'output_function' in func_info:
+            output_function = func_info['output_function']
+
+            if 'output_dir' in func_info:
+                output_dir = os.path.join(output_dir_root, func_info['output_dir'])
+
+            outputs = instrument.call(f"{output_function.__name__}:{func_info['output_dir']}", 'output', output_function, data, output_dir, name)
+
+            if key is not None:
+                manifest.record(outputs_manifest, output_dir_root, key, inputs, spec, outputs)
+
+    # Entries sharing their first stages (dropna, groupby, outlier removal) compute them once
+    dag = stages.compile_stages([func_info for func_info, _, _ in pending], dropna=True)
+    try:
+        stages.run_stages(dag, all_data, output)
+    finally:
+        # Once per scope rather than after every output, keeping what was written if a function fails
+        if incremental and pending:
+            manifest.save_manifest(outputs_manifest, output_dir_root)
+
+# The processed tree of every scope, next to the root
+SCOPE_SUFFIXES = {
+    'experiments': '_processed_by_experiment',
+    'all': '_processed',
+    'clients': '_processed_by_client'
+}
+
+def processed_dir(root_dir, suffix):
+    return os.path.join(os.path.dirname(root_dir), os.path.basename(root_dir) + suffix)
 
-            if 'data_process_function' in func_info:
-                process_function = func_info['data_process_function']
-                data = process_function(data)
+def remove_stale_scopes(output_dir_root, names):
+    # The outputs (<output_dir>/<name>) of the scopes left without records, e.g. the experiment
+    # or the client whose last CSV was removed
+    results.remove_outputs(output_dir_root, lambda key: os.path.basename(key) not in names)
+
+def process_experiments(root_dir, column, functions, records=None, experiments=None, incremental=False):
+    if records is None:
+        records = ingest(root_dir)
 
-            data = function(data)
+    # By default process every experiment found under root_dir
+    if experiments is None:
+        experiments = records['Experiment'].unique()
+
+    output_dir_root = processed_dir(root_dir, SCOPE_SUFFIXES['experiments'])
+    if incremental:
+        remove_stale_scopes(output_dir_root, set(records['Experiment']))
+
+    for experiment in experiments:
+        with instrument.span(experiment, 'experiment', root=root_dir):
+            inputs = select_inputs(records, experiment=experiment) if incremental else None
+            apply_functions(select(records, experiment=experiment), functions, output_dir_root, experiment, inputs)
+
+def process_all(root_dir, column, functions, records=None, incremental=False):
+    if records is None:
+        records = ingest(root_dir)
+
+    if incremental:
+        remove_stale_scopes(processed_dir(root_dir, SCOPE_SUFFIXES['all']), {'all'} if len(records) else set())
 
-            if 'output_function' in func_info:
-                output_function = func_info['output_function']
-
-                if 'output_dir' in func_info:
-                    output_dir = func_info['output_dir']
-                    output_dir = os.path.join(os.path.dirname(root_dir), os.path.basename(root_dir) + '_processed', output_dir)
-
-                output_function(data, output_dir, 'all')
-
-        del subdirList[:]  # Prevent os.walk from descending into subdirectories
-
-def process_clients(root_dir, column, functions):
-    clients = ['degroot', 'miletus', 'nancy', 'lille', 'grenoble', 'sophia', 'rennes']
-    clients_dic = {}
-    for client in clients:
-        clients_dic[client] = pd.DataFrame()
-
-    # all_data = pd.DataFrame()
-
-    for dirName, subdirList, fileList in os.walk(root_dir):
-        print('Found directory:', dirName)
-        found_csv_foler = False
-
-        for fname in fileList:
-            if fname.endswith('.csv'):
-                for client in clients_dic:
-                    if client in fname:
-                        print('\tProcessing file:', fname)
-                        file_path = os.path.join(dirName, fname)
-                        found_csv_foler = True
-
-                        data = results.read_all(file_path, dropna=False)
-                        clients_dic[client] = pd.concat([clients_dic[client], data], ignore_index=True)
-                    
     # Process the data only after all CSV files have been appended
-    if found_csv_foler:
-        for func_info in functions:
-            for client in clients_dic:
-                data = clients_dic[client].copy()
+    if len(records):
+        with instrument.span('all', 'all', root=root_dir):
+            output_dir_root = processed_dir(root_dir, SCOPE_SUFFIXES['all'])
+            inputs = select_inputs(records) if incremental else None
+            apply_functions(select(records), functions, output_dir_root, 'all', inputs)
 
-                if len(data):
-                    dropna = func_info.get('dropna', True)
-                    if dropna:
-                        data.dropna(inplace=True)
-                    
-                    if 'data_load_function' in func_info:
-                        args = func_info['args']
-                        data_load_function = func_info['data_load_function']
-                        data = data_load_function(data, *args)
-                    
-                    function = func_info['function']
+def process_clients(root_dir, column, functions, records=None, clients=None, incremental=False):
+    if records is None:
+        records = ingest(root_dir)
 
-                    if 'data_process_function' in func_info:
-                        process_function = func_info['data_process_function']
-                        data = process_function(data)
+    # By default process every client found under root_dir
+    if clients is None:
+        clients = sorted(records['Client'].unique())
 
-                    data = function(data)
+    output_dir_root = processed_dir(root_dir, SCOPE_SUFFIXES['clients'])
+    if incremental:
+        remove_stale_scopes(output_dir_root, set(records['Client']))
 
-                    if 'output_function' in func_info:
-                        output_function = func_info['output_function']
-
-                        if 'output_dir' in func_info:
-                            output_dir = func_info['output_dir']
-                            output_dir = os.path.join(os.path.dirname(root_dir), os.path.basename(root_dir) + '_processed_by_client', output_dir)
-
-                        output_function(data, output_dir, client)
-
-        del subdirList[:]  # Prevent os.walk from descending into subdirectories
-
-
-if __name__ == "__main__":
-    # List of functions to apply
-    functions = [
+    for client in clients:
+        data = select(records, client=client)
+
+        if len(data):
+            with instrument.span(client, 'client', root=root_dir):
+                inputs = select_inputs(records, client=client) if incremental else None
+                apply_functions(data, functions, output_dir_root, client, inputs)
+
+SCOPES = {
+    'experiments': process_experiments,
+    'all': process_all,
+    'clients': process_clients
+}
+
+def process_root(root_dir, column, functions, scopes=list(SCOPES), incremental=False, render_workers=None, stage_workers=None, engine='pandas'):
+    # Ingest root_dir once and compute the given scopes over it. Errors are returned
+    # instead of raised, so that a bad CSV or a failing scope doesn't stop the other jobs.
+    results.configure_rendering(render_workers)
+    if stage_workers is not None:
+        stages.WORKERS = stage_workers
+
+    errors = []
+    try:
+        if engine == 'sql':
+            # Imported here, the SQL engine imports this module itself
+            import sql_backend
+            functions = sql_backend.process_scopes(root_dir, column, functions, scopes, incremental=incremental)
+
+        with instrument.span(root_dir, 'ingest'):
+            records = ingest(root_dir, errors=errors)
+
+        for scope in scopes:
+            SCOPES[scope](root_dir, column, functions, records=records, incremental=incremental)
+
+        results.finish_rendering()
+        output_store.flush()
+    except Exception as e:
+        traceback.print_exc()
+        errors.append(f'{root_dir} ({", ".join(scopes)}): {type(e).__name__}: {e}')
+
+    return errors
+
+def process_root_job(*args):
+    # process_root in a worker process, handing its instrumentation events back with the errors
+    errors = process_root(*args)
+    return errors, instrument.take_events()
+
+def process_roots(root_dirs, column, functions, jobs=1, incremental=False, engine='pandas'):
+    # With several jobs, every (root, scope) pair runs in its own process. Each scope writes
+    # to its own processed tree and manifest, so the outputs don't depend on the scheduling.
+    if jobs > 1:
+        job_list = [(root_dir, [scope]) for root_dir in root_dirs for scope in SCOPES]
+    else:
+        job_list = [(root_dir, list(SCOPES)) for root_dir in root_dirs]
+
+    job_errors = {}
+
+    def report(job, errors):
+        job_errors[job] = errors
+        root_dir, scopes = job_list[job]
+        logger.info('[%d/%d] Finished %s (%s) with %d errors', len(job_errors), len(job_list), root_dir, ', '.join(scopes), len(errors))
+
+    if jobs > 1:
+        # Figures are drawn inside the jobs, their processes can't start render pools of their own
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = {pool.submit(process_root_job, root_dir, column, functions, scopes, incremental, 0, stages.WORKERS, engine): job for job, (root_dir, scopes) in enumerate(job_list)}
+
+            for future in as_completed(futures):
+                try:
+                    errors, events = future.result()
+                    instrument.add_events(events)
+                except Exception as e:
+                    root_dir, scopes = job_list[futures[future]]
+                    errors = [f'{root_dir} ({", ".join(scopes)}): {type(e).__name__}: {e}']
+                report(futures[future], errors)
+    else:
+        for job, (root_dir, scopes) in enumerate(job_list):
+            report(job, process_root(root_dir, column, functions, scopes, incremental, engine=engine))
+
+    # Jobs over the same root report the same bad files
+    errors = list(dict.fromkeys(error for job in range(len(job_list)) for error in job_errors[job]))
+    if errors:
+        logger.error('%d errors:', len(errors))
+        for error in errors:
+            logger.error('\t%s', error)
+
+    return errors
+
+# List of functions to apply
+FUNCTIONS = [
     {
         'function': results.plot_distribution,
         'data_load_function': groupby,
@@ -248,16 +431,81 @@ if __name__ == "__main__":
         'output_function': results.save_csv,
         'output_dir': 'data_grouped'
     }
-    ]
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='regenerate every output, ignoring the manifests')
+    parser.add_argument('--render-workers', type=int, default=os.cpu_count(), help='processes drawing the figures, 0 to draw them serially')
+    parser.add_argument('--max-open-figures', type=int, default=results.MAX_OPEN_FIGURES, help='figures queued or being drawn at once')
+    parser.add_argument('--stage-workers', type=int, default=stages.WORKERS, help='threads running independent stages of the functions list at once')
+    parser.add_argument('--bootstrap', type=int, default=0, help='resamples for the confidence intervals of the mean and median in the measures, 0 to skip them')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the bootstrap intervals')
+    parser.add_argument('--seed', type=int, help='seed of the bootstrap resampling')
+    parser.add_argument('--outlier-method', metavar='METHOD', help="method of the outlier removal, e.g. 'iqr:k=3', 'mad:z=3.5', 'percentile:low=1,high=99' or 'cutoff:high=15000'")
+    parser.add_argument('--outlier-methods', metavar='METHOD', nargs='+', help='also compare these outlier methods on every group, writing the outlier_methods tables')
+    parser.add_argument('--jobs', type=int, default=1, help='processes computing the roots and scopes in parallel')
+    parser.add_argument('--read-workers', type=int, default=results.READ_WORKERS, help='threads reading the CSVs ahead of their processing, 0 to read each one when it is used')
+    parser.add_argument('--read-ahead', type=int, default=results.READ_AHEAD, help='CSVs read or being read ahead at once')
+    parser.add_argument('--record-store', action='store_true', help='read the records from the memory-mapped record store, building or updating it first')
+    parser.add_argument('--engine', default='pandas', choices=['pandas', 'sql'], help='sql computes the measures and NA ratios of every scope as SQL queries over all the files')
+    parser.add_argument('--small-multiples', action='store_true', help='draw the histograms of all the sizes in one figure instead of one figure per size')
+    parser.add_argument('--stats-only', action='store_true', help='skip the figures, computing only the tables without loading the plotting libraries')
+    parser.add_argument('--output-mode', default='files', choices=['files', 'store'], help='store collects the tables into the consolidated output store instead of a file each')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='DEBUG also logs the details of every group')
+    parser.add_argument('--instrument', metavar='PREFIX', help='record the time and memory of every stage, writing PREFIX.json and the Chrome trace PREFIX.trace.json')
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level, format='%(message)s')
+    instrument.enable(cli_args.instrument is not None)
+    results.configure_rendering(cli_args.render_workers, cli_args.max_open_figures)
+    results.configure_reading(cli_args.read_workers, cli_args.read_ahead)
+    stages.WORKERS = cli_args.stage_workers
+
+    # List of functions to apply
+    functions = [dict(func_info) for func_info in FUNCTIONS]
+
+    if cli_args.bootstrap:
+        for func_info in functions:
+            if func_info['function'] in [results.find_measures, results.remove_outliers_and_find_measures]:
+                func_info['function_kwargs'] = {'bootstrap': cli_args.bootstrap, 'confidence': cli_args.confidence, 'seed': cli_args.seed}
+
+    if cli_args.outlier_method:
+        functions = results.use_outlier_method(functions, cli_args.outlier_method)
+
+    if cli_args.outlier_methods:
+        functions.append({
+            'function': results.compare_outlier_methods,
+            'data_load_function': groupby,
+            'args': [],
+            'function_kwargs': {'methods': cli_args.outlier_methods},
+            'output_function': results.save_csv,
+            'output_dir': 'outlier_methods'
+        })
+
+    if cli_args.record_store:
+        record_store.update_store()
+        record_store.enable()
+
+    if cli_args.small_multiples:
+        functions = results.use_small_multiples(functions)
+
+    if cli_args.stats_only:
+        functions = results.use_stats_only(functions)
+
+    if cli_args.output_mode == 'store':
+        functions = results.use_output_store(functions)
 
-    root_dirs = [
-        './accumulated_csv_records/11-06 & 12-06 & 16-06 - 18-06/ipfs/retrieve',
-        './accumulated_csv_records/miletus_degroot_nancy/19-06-2023/ipfs/retrieve',
-        './accumulated_csv_records/13-06 & 18-06/swarm/retrieve'
-    ]
     column = 'Retrieval Time (ms)'
 
-    for root_dir in root_dirs:
-        process_experiments(root_dir, column, functions)
-        process_all(root_dir, column, functions)
-        process_clients(root_dir, column, functions)
+    if cli_args.engine == 'sql':
+        # Loaded once here, the jobs only query the database
+        import sql_backend
+        sql_backend.update_database(records_index.update_index())
+
+    errors = process_roots(results.ROOT_DIRS, column, functions, jobs=cli_args.jobs, incremental=not cli_args.full, engine=cli_args.engine)
+
+    if cli_args.instrument:
+        instrument.save(cli_args.instrument)
+
+    sys.exit(1 if errors else 0)
@@ -1,8 +1,63 @@
 import os
+import hashlib
+import pickle
+import logging
+import argparse
+import itertools
+import threading
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+
+import manifest
+import stages
+import instrument
+import output_store
+import outliers
+
+# matplotlib and seaborn are imported by the functions drawing the figures, so runs that draw none
+# (see use_stats_only) never load them. They are most of the time it takes to import this module.
+
+# Progress goes to INFO, the per group details to DEBUG
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = '%a %b %d %Y %H:%M:%S'
+COLUMN_TYPES = {
+    'Retrieval Time (ms)': 'float64',
+    'Size in Repo(Bytes)': 'Int64',
+    'Type': 'category',
+    'Size (Bytes)': 'Int64'
+}
+
+# Figures are drawn and saved by this many processes (0 draws them in the calling process),
+# with at most MAX_OPEN_FIGURES of them queued or in progress at any time
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 0))
+MAX_OPEN_FIGURES = int(os.environ.get('MAX_OPEN_FIGURES', 32))
+render_pool = None
+pending_renders = set()
+
+# Parsed CSVs are cached here. Set to None to always parse the CSV files.
+CACHE_DIR = os.environ.get('RECORDS_CACHE_DIR', '.records_cache')
+
+# Files are read by this many threads ahead of their use (0 reads every file when it is used), with at
+# most READ_AHEAD of them being read or waiting to be used at once, see read_ahead(). On network
+# filesystems the latency of every read, not parsing, is what takes the time, so reads overlap it.
+READ_WORKERS = int(os.environ.get('READ_WORKERS', 0))
+READ_AHEAD = int(os.environ.get('READ_AHEAD', 8))
+read_pool = None
+# {(path, na_values): future of its records}, taken by read_records
+prefetched = {}
+
+# Parsed CSVs kept in memory by long-running processes, {path: {'fingerprint', 'data'}}, see keep_records_in_memory()
+records_memory = None
+
+# The roots both scripts process
+ROOT_DIRS = [
+    './accumulated_csv_records/11-06 & 12-06 & 16-06 - 18-06/ipfs/retrieve',
+    './accumulated_csv_records/miletus_degroot_nancy/19-06-2023/ipfs/retrieve',
+    './accumulated_csv_records/13-06 & 18-06/swarm/retrieve'
+]
 
 def bytes_to_size(size, decimal_places=0):
     units = ['B', 'KB', 'MB', 'GB']
@@ -15,41 +70,252 @@ def bytes_to_size(size, decimal_places=0):
         else:
             size /= 1024.0
 
+def size_to_bytes(size):
+    # Inverse of bytes_to_size: '16KB', '1MiB' or '4096' -> number of bytes
+    if not isinstance(size, str):
+        return int(size)
+
+    units = ['B', 'KB', 'MB', 'GB']
+    size = size.strip().upper().replace('IB', 'B')
+
+    for exponent, unit in reversed(list(enumerate(units))):
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * 1024 ** exponent)
+
+    return int(size)
+
+# A figure that has not been drawn yet: function(*args) creates it. Plotting functions return
+# these so that the figures can be drawn, saved and closed one by one by the render pool.
+FigurePlot = namedtuple('FigurePlot', ['name', 'function', 'args'])
+
+# Histogram and KDE of every group as seaborn's histplot(kde=True) draws them: numpy's 'auto' number
+# of equal bins between the min and the max, and a Gaussian KDE with Scott's bandwidth evaluated at
+# KDE_GRIDSIZE points between the min and the max, scaled to the counts. All the groups are binned
+# in one pass and their KDEs come from one batched FFT convolution over a fine grid (KDE_REFINE
+# grid points per bandwidth, at most KDE_MAX_REFINE per support point) instead of a gaussian_kde each.
+KDE_GRIDSIZE = 200
+KDE_REFINE = 8
+KDE_MAX_REFINE = 256
+
+Distribution = namedtuple('Distribution', ['name', 'edges', 'counts', 'support', 'density', 'stats'])
+Distributions = namedtuple('Distributions', ['column', 'groups'])
+
+def histogram_bins(size, low, high, q1, q3):
+    # numpy's 'auto' rule: the smaller of the Freedman-Diaconis and Sturges bin widths, one bin if both are 0
+    sturges = (high - low) / (np.log2(size) + 1.0)
+    fd = 2.0 * (q3 - q1) * size ** (-1.0 / 3.0)
+    width = np.where(fd > 0, np.minimum(fd, sturges), sturges)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(width > 0, np.ceil((high - low) / width), 1).astype(np.int64)
+
+def histogram_counts(values, codes, low, high, bins):
+    # np.histogram(..., bins, range=(low, high)) of every group at once, edges and counts concatenated group after group
+    edge_offsets = np.concatenate([[0], np.cumsum(bins + 1)])
+    count_offsets = edge_offsets[:-1] - np.arange(len(bins))
+
+    steps = np.repeat(np.arange(len(bins)), bins + 1)
+    positions = np.arange(edge_offsets[-1]) - edge_offsets[steps]
+    edges = low[steps] + positions * ((high - low) / bins)[steps]
+    edges[edge_offsets[1:] - 1] = high
+
+    indices = ((values - low[codes]) / (high - low)[codes] * bins[codes]).astype(np.int64)
+    indices[indices == bins[codes]] -= 1
+
+    # Like numpy, move the values that rounding put next to their bin back in it
+    first = edge_offsets[codes]
+    indices[values < edges[first + indices]] -= 1
+    indices[(values >= edges[first + indices + 1]) & (indices != bins[codes] - 1)] += 1
+
+    counts = np.bincount(count_offsets[codes] + indices, minlength=bins.sum())
+    return np.split(edges, edge_offsets[1:-1]), np.split(counts, count_offsets[1:])
+
+def binned_kde(values, codes, low, high, bandwidth, gridsize=KDE_GRIDSIZE):
+    # Sum of the Gaussian kernels of every group at gridsize points between its min and max. The values
+    # are linearly binned on a grid refine times finer and convolved with the kernels, all groups in one FFT.
+    ratio = np.max((high - low) / bandwidth) if len(values) else 0
+    refine = int(np.clip(np.ceil(KDE_REFINE * ratio / (gridsize - 1)), 1, KDE_MAX_REFINE))
+    points = (gridsize - 1) * refine + 1
+    spacing = (high - low) / (points - 1)
+
+    positions = (values - low[codes]) / spacing[codes]
+    lower = np.minimum(positions.astype(np.int64), points - 2)
+    fraction = positions - lower
+
+    cells = codes * points + lower
+    weights = np.bincount(cells, 1 - fraction, len(low) * points) + np.bincount(cells + 1, fraction, len(low) * points)
+    weights = weights.reshape(len(low), points)
+
+    # Kernel at every distance in grid points, negative distances wrapping around for the circular convolution
+    length = 2 * points
+    distances = np.minimum(np.arange(length), length - np.arange(length))
+    kernels = np.exp(-0.5 * (distances * (spacing / bandwidth)[:, None]) ** 2)
+
+    sums = np.fft.irfft(np.fft.rfft(weights, length) * np.fft.rfft(kernels), length)[:, :points:refine]
+    return np.linspace(low, high, gridsize, axis=1), sums / (np.sqrt(2 * np.pi) * bandwidth[:, None])
+
+def distribution_cache_file(values, codes, names, column):
+    key = hashlib.sha1(repr((list(names), column, KDE_GRIDSIZE, KDE_REFINE, KDE_MAX_REFINE)).encode())
+    key.update(np.ascontiguousarray(values).tobytes())
+    key.update(np.ascontiguousarray(codes).tobytes())
+
+    return os.path.join(CACHE_DIR, 'distributions', key.hexdigest() + '.pkl')
+
+def group_distributions(data, column='Retrieval Time (ms)'):
+    # The histograms, KDEs and text statistics of every group. The plotting functions accept either grouped
+    # data or the result of this function, so the histograms and small multiples share one computation.
+    # Results are cached by the content of the groups, a scope whose data didn't change isn't recomputed.
+    if isinstance(data, Distributions) and data.column == column:
+        return data
+
+    codes = data.ngroup().to_numpy()
+    grouped = codes >= 0
+    values = data.obj[column].to_numpy(dtype=float)[grouped]
+    codes = codes[grouped]
+
+    stats = data[column].agg(['mean', 'std', 'median', 'var', 'skew', 'min', 'max', 'size'])
+    quartiles = data[column].quantile([0.25, 0.75]).unstack()
+
+    cache_file = None
+    if CACHE_DIR is not None:
+        cache_file = distribution_cache_file(values, codes, stats.index, column)
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            return Distributions(cached['column'], [Distribution(*group) for group in cached['groups']])
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, TypeError, KeyError):
+            pass
+
+    size = stats['size'].to_numpy()
+    low = stats['min'].to_numpy(dtype=float)
+    high = stats['max'].to_numpy(dtype=float)
+
+    # A group of equal values gets one bin of width 1 around them and, like in seaborn, no KDE
+    single = low == high
+    low, high = np.where(single, low - 0.5, low), np.where(single, high + 0.5, high)
+    bins = histogram_bins(size, low, high, quartiles[0.25].to_numpy(), quartiles[0.75].to_numpy())
+    edges, counts = histogram_counts(values, codes, low, high, bins)
+
+    # Scott's rule, seaborn's default bandwidth
+    std = stats['std'].to_numpy(dtype=float)
+    has_kde = (size > 1) & (std > 0)
+    kde_groups = np.flatnonzero(has_kde)
+    selected = has_kde[codes]
+    support, sums = binned_kde(values[selected], np.searchsorted(kde_groups, codes[selected]), low[has_kde], high[has_kde], std[has_kde] * size[has_kde] ** -0.2)
+
+    groups = []
+    for i, name in enumerate(stats.index):
+        density = None
+        if has_kde[i]:
+            position = np.searchsorted(kde_groups, i)
+            # histplot scales the density (sums / size) to the area of the bars (size * bin width)
+            density = sums[position] * (high[i] - low[i]) / bins[i]
+            support_i = support[position]
+        else:
+            support_i = None
+
+        group_stats = {measure: stats[measure].iloc[i] for measure in ['mean', 'std', 'median', 'var', 'skew']}
+        groups.append(Distribution(bytes_to_size(name), edges[i], counts[i], support_i, density, group_stats))
+
+    distributions = Distributions(column, groups)
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            # Plain tuples, the namedtuples pickled by a run of this script would belong to __main__
+            pickle.dump({'column': column, 'groups': [tuple(group) for group in groups]}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+
+    return distributions
+
+def draw_distribution(ax, distribution, column, label=None):
+    # The bars and KDE line of sns.histplot(kde=True) from the precomputed histogram
+    import matplotlib
+    from matplotlib.colors import to_rgba
+
+    widths = np.diff(distribution.edges)
+    bars = ax.bar(distribution.edges[:-1], distribution.counts, widths, align='edge', color='none', facecolor=to_rgba('C0', 0.5), edgecolor=matplotlib.rcParams['patch.edgecolor'], label=label)
+    for bar in bars:
+        bar.sticky_edges.x[:] = []
+        bar.sticky_edges.y[:] = [0, np.inf]
+
+    if distribution.density is not None:
+        line, = ax.plot(distribution.support, distribution.density, color=to_rgba('C0', 1))
+        line.sticky_edges.y[:] = [0, np.inf]
+
+    ax.set_xlabel(column)
+    ax.set_ylabel('Count')
+
+    # Bar edges a tenth of the bar width at most, so narrow bars aren't all edge
+    ax.autoscale_view()
+    start = distribution.edges[0]
+    bar_points = 72 / ax.figure.dpi * abs(ax.transData.transform([start + widths.min(), 0])[0] - ax.transData.transform([start, 0])[0])
+    for bar in bars:
+        bar.set_linewidth(min(0.1 * bar_points, bar.get_linewidth()))
+
+def distribution_figure(distribution, column):
+    import matplotlib.pyplot as plt
+
+    name = distribution.name
+    stats = distribution.stats
+
+    # Create figure and axes
+    fig, ax = plt.subplots()
+    
+    draw_distribution(ax, distribution, column, label=name)
+
+    # Add info about data
+    fig.text(0.75, 0.85, f'Mean: {stats["mean"]:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
+    fig.text(0.75, 0.80, f'Std: {stats["std"]:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
+    fig.text(0.75, 0.75, f'Median: {stats["median"]:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
+    fig.text(0.75, 0.70, f'Variance: {stats["var"]:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
+    fig.text(0.75, 0.65, f'Skewness: {stats["skew"]:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
+    fig.name = name
+
+    plt.legend()
+    # plt.show()
+    return fig
+
 def plot_distribution(data, column='Retrieval Time (ms)'):
     figs = []
     
-    for name, group in data:
-        name = bytes_to_size(name)
+    for distribution in group_distributions(data, column).groups:
+        logger.debug('Plotting distribution for group: %s', distribution.name)
 
-        print(f"Plotting distribution for group: {name}")
+        figs.append(FigurePlot(distribution.name, distribution_figure, (distribution, column)))
 
-        group_data = group[column]
-        mean = group_data.mean()
-        std = group_data.std()
-        median = group_data.median()
-        variance = group_data.var()
-        skewness = group_data.skew()
+    return figs
 
-        # Create figure and axes
-        fig, ax = plt.subplots()
-        
-        sns.histplot(group[column], kde=True, label=name)
+def distribution_grid_figure(distributions, column):
+    # Small multiples: the histogram of every size in one figure, in rows of up to 4
+    import matplotlib.pyplot as plt
 
-        # Add info about data
-        fig.text(0.75, 0.85, f'Mean: {mean:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
-        fig.text(0.75, 0.80, f'Std: {std:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
-        fig.text(0.75, 0.75, f'Median: {median:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
-        fig.text(0.75, 0.70, f'Variance: {variance:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
-        fig.text(0.75, 0.65, f'Skewness: {skewness:.2f}', horizontalalignment='center', verticalalignment='center', transform=ax.transAxes, fontsize=12)
-        fig.name = name
+    columns = min(4, max(1, len(distributions)))
+    rows = max(1, -(-len(distributions) // columns))
+    fig, axes = plt.subplots(rows, columns, figsize=(4 * columns, 3 * rows), squeeze=False)
 
-        figs.append(fig)
+    for ax, distribution in zip(axes.flat, distributions):
+        draw_distribution(ax, distribution, column)
+        ax.set_title(distribution.name)
+        ax.text(0.97, 0.95, f'Mean: {distribution.stats["mean"]:.2f}\nMedian: {distribution.stats["median"]:.2f}', horizontalalignment='right', verticalalignment='top', transform=ax.transAxes, fontsize=8)
 
-        plt.legend()
-        # plt.show()
-    return figs
+    for ax in axes.flat[len(distributions):]:
+        ax.set_visible(False)
+
+    fig.tight_layout()
+    return fig
+
+def plot_distribution_grid(data, column='Retrieval Time (ms)'):
+    return FigurePlot(None, distribution_grid_figure, (group_distributions(data, column).groups, column))
+
+plot_distribution.shared_stage = group_distributions
+plot_distribution_grid.shared_stage = group_distributions
+
+def boxplot_figure(data, x, y):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
-def plot_boxplot(data, x='Size (Bytes)', y='Retrieval Time (ms)'):
     fig, _ = plt.subplots()
 
     data = data.sort_values(by=x)
@@ -58,12 +324,160 @@ def plot_boxplot(data, x='Size (Bytes)', y='Retrieval Time (ms)'):
 
     return fig
 
-def group_results(data):
-    # DataFrame for concatenating all groups
-    data_grouped = pd.DataFrame()
+def plot_boxplot(data, x='Size (Bytes)', y='Retrieval Time (ms)'):
+    return FigurePlot(None, boxplot_figure, (data[[x, y]], x, y))
+
+def render_figure(fig, file_path):
+    import matplotlib.pyplot as plt
+
+    if isinstance(fig, FigurePlot):
+        fig = fig.function(*fig.args)
+
+    fig.savefig(file_path)
+    plt.close(fig)
+
+    return file_path
+
+def use_agg():
+    # Render processes draw without a display
+    import matplotlib
+    matplotlib.use('Agg')
+
+def configure_rendering(workers=None, max_open_figures=None):
+    # workers: number of render processes, 0 renders in this process.
+    # max_open_figures: figures queued or being drawn at once before submitting blocks.
+    global RENDER_WORKERS, MAX_OPEN_FIGURES
+
+    if workers is not None:
+        RENDER_WORKERS = workers
+    if max_open_figures is not None:
+        MAX_OPEN_FIGURES = max(1, max_open_figures)
+
+def submit_render(fig, file_path):
+    global render_pool
+
+    # Figures that already exist can't be shipped to another process, so draw them here
+    if RENDER_WORKERS < 1 or not isinstance(fig, FigurePlot):
+        render_figure(fig, file_path)
+        return
+
+    if render_pool is None:
+        render_pool = ProcessPoolExecutor(RENDER_WORKERS, initializer=use_agg)
+
+    # Wait for some figures to be written before queueing more, so memory stays bounded
+    while len(pending_renders) >= MAX_OPEN_FIGURES:
+        done, _ = wait(pending_renders, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending_renders.remove(future)
+            future.result()
+
+    pending_renders.add(render_pool.submit(render_figure, fig, file_path))
+
+def finish_rendering(keep_workers=False):
+    # Wait for every submitted figure to be written and stop the render processes,
+    # unless keep_workers, for processes that will draw more figures later on
+    global render_pool
+
+    for future in list(pending_renders):
+        pending_renders.remove(future)
+        future.result()
+
+    if render_pool is not None and not keep_workers:
+        render_pool.shutdown()
+        render_pool = None
+
+MEASURES_COLUMNS = {
+    'mean': 'Mean',
+    'std': 'Std',
+    'median': 'Median',
+    'var': 'Variance',
+    'skew': 'Skewness',
+    'min': 'Min',
+    'max': 'Max',
+    'size': 'Group size'
+}
+
+def group_statistics(data, column='Retrieval Time (ms)', k=1.5):
+    # Compute every per-group measure, the quartiles and the outlier gates of all groups
+    # in one grouped pass. The result has one row per group, in group order.
+    values = data[column]
+
+    stats = values.agg(list(MEASURES_COLUMNS))
+    # Without any group, e.g. for a header-only CSV, unstack leaves no quartile columns
+    quartiles = values.quantile([0.25, 0.75]).unstack().reindex(columns=[0.25, 0.75])
+    stats['Q1'] = quartiles[0.25]
+    stats['Q3'] = quartiles[0.75]
+
+    outlier_step = k * (stats['Q3'] - stats['Q1'])
+    stats['Lower gate'] = stats['Q1'] - outlier_step
+    stats['Upper gate'] = stats['Q3'] + outlier_step
+
+    return stats
+
+def outlier_masks(data, stats, column='Retrieval Time (ms)'):
+    # For every row of the grouped DataFrame return its group number and
+    # whether it falls outside or inside its group's outlier gates
+    codes = data.ngroup().to_numpy()
+    values = data.obj[column].to_numpy()
+    grouped = codes >= 0
+
+    lower = stats['Lower gate'].to_numpy()[codes]
+    upper = stats['Upper gate'].to_numpy()[codes]
+    outliers = grouped & ((values < lower) | (values > upper))
+    inliers = grouped & (values >= lower) & (values <= upper)
+
+    return codes, outliers, inliers
+
+def merged_statistics(data, column='Retrieval Time (ms)', k=1.5):
+    # The group statistics the grouped data carries in its attrs, merged from the summaries of the
+    # files it was selected from (see process_folders.select), with the gates of k. None if there
+    # are none, or they aren't those of these groups, e.g. of the data before removing outliers.
+    merged = data.obj.attrs.get('group_statistics')
+    if merged is None or merged[0] != column:
+        return None
+
+    _, groups, columns = merged
+    stats = pd.DataFrame(dict(columns), index=pd.Index(groups, name='Size (Bytes)'))
+    sizes = data.size()
+    if not stats.index.equals(sizes.index) or not np.array_equal(stats['size'].to_numpy(), sizes.to_numpy()):
+        return None
+
+    outlier_step = k * (stats['Q3'] - stats['Q1'])
+    stats['Lower gate'] = stats['Q1'] - outlier_step
+    stats['Upper gate'] = stats['Q3'] + outlier_step
+
+    return stats
+
+# The grouped data together with its group statistics and per-row outlier masks
+OutlierSplit = namedtuple('OutlierSplit', ['data', 'column', 'stats', 'codes', 'outliers', 'inliers'])
+
+def split_outliers(data, column='Retrieval Time (ms)', method='iqr'):
+    # The functions below accept either grouped data or the result of this function, so a pipeline
+    # running several of them over the same groups only computes the statistics and masks once.
+    # method is any method of the outliers module, e.g. 'mad:z=3.5', Tukey's 1.5 IQR by default.
+    if isinstance(data, OutlierSplit) and data.column == column:
+        return data
+
+    name, params = outliers.parse_method(method)
+    stats = merged_statistics(data, column, k=params.get('k', 1.5))
+    if stats is None:
+        stats = group_statistics(data, column, k=params.get('k', 1.5))
+    if name != 'iqr':
+        stats['Lower gate'], stats['Upper gate'] = outliers.gates(outliers.sort_groups(data, column), method)
+
+    codes, outlier_rows, inliers = outlier_masks(data, stats, column)
+
+    return OutlierSplit(data, column, stats, codes, outlier_rows, inliers)
+
+def group_positions(codes, mask):
+    # Positions of the selected rows, ordered group by group (as concatenating
+    # the groups one after the other would order them)
+    positions = np.flatnonzero(mask)
+    return positions[np.argsort(codes[positions], kind='stable')]
 
-    for name, group in data:
-        data_grouped = pd.concat([data_grouped, group])
+def group_results(data):
+    codes = data.ngroup().to_numpy()
+    data_grouped = data.obj.iloc[group_positions(codes, codes >= 0)]
     
     # when resetting the index, the old index is added as a column
     data_grouped = data_grouped.reset_index()
@@ -71,150 +485,337 @@ def group_results(data):
 
 def average(data, column='Retrieval Time (ms)'):
     rows = []
-    for name, group in data:
+    for name, average in data[column].mean().items():
         name = bytes_to_size(name)
         cols = []
 
-        average = group[column].mean()
         message = f"Size: {name} Average value is: {average}"
         cols.append(message)
-        print(message)
+        logger.debug(message)
 
         rows.append(cols)
     
     return rows
 
-def find_measures(data, column='Retrieval Time (ms)'):  
-    measures = []
-    for name, group in data:
-        name = bytes_to_size(name)
+def bootstrap_intervals(data, column='Retrieval Time (ms)', resamples=1000, confidence=0.95, seed=None, max_batch_values=2**22):
+    # Percentile bootstrap confidence intervals of the mean and the median of every group.
+    # All groups are resampled together: the rows are sorted by (group, value) and each batch
+    # draws a (resamples x rows) array of indices, every row's index falling within its own group.
+    groups = data.size().index
+    codes = data.ngroup().to_numpy()
+    values = data.obj[column].to_numpy(dtype=float)
+
+    keep = (codes >= 0) & ~np.isnan(values)
+    order = np.lexsort((values[keep], codes[keep]))
+    codes, values = codes[keep][order], values[keep][order]
+
+    counts = np.bincount(codes, minlength=len(groups))
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    lower_middle = starts[present] + (counts[present] - 1) // 2
+    upper_middle = starts[present] + counts[present] // 2
+
+    rng = np.random.default_rng(seed)
+    batch = max(1, max_batch_values // max(len(values), 1))
+    means, medians = [], []
+
+    for done in range(0, resamples, batch):
+        indices = starts[codes] + (rng.random((min(batch, resamples - done), len(values))) * counts[codes]).astype(np.int64)
 
-        print(f"Calculating measures for group: {name}")
-        
-        group_data = group[column]
+        means.append(np.add.reduceat(values[indices], starts[present], axis=1) / counts[present])
 
-        mean = group_data.mean()
-        std = group_data.std()
-        median = group_data.median()
-        variance = group_data.var()
-        skewness = group_data.skew()
+        # Indices are sorted by (group, value), so sorting them sorts every resampled group too
+        indices.sort(axis=1)
+        medians.append((values[indices[:, lower_middle]] + values[indices[:, upper_middle]]) / 2)
 
-        measures.append([name, mean, std, median, variance, skewness, group_data.min(), group_data.max(), len(group_data)])
+    alpha = (1 - confidence) / 2
+    intervals = pd.DataFrame(np.nan, index=groups, columns=['Mean CI low', 'Mean CI high', 'Median CI low', 'Median CI high'])
+    if len(values):
+        intervals.loc[present, ['Mean CI low', 'Mean CI high']] = np.quantile(np.vstack(means), [alpha, 1 - alpha], axis=0).T
+        intervals.loc[present, ['Median CI low', 'Median CI high']] = np.quantile(np.vstack(medians), [alpha, 1 - alpha], axis=0).T
 
-    df = pd.DataFrame(measures, columns=['Group', 'Mean', 'Std', 'Median', 'Variance', 'Skewness', 'Min', 'Max', 'Group size'])
+    return intervals
+
+def find_measures(data, column='Retrieval Time (ms)', bootstrap=0, confidence=0.95, seed=None):
+    # With bootstrap > 0, the confidence intervals of the mean and median from that many resamples are added
+    data, _, stats, _, _, _ = split_outliers(data, column)
+
+    names = [bytes_to_size(name) for name in stats.index]
+    if logger.isEnabledFor(logging.DEBUG):
+        for name in names:
+            logger.debug('Calculating measures for group: %s', name)
+
+    df = stats[list(MEASURES_COLUMNS)].rename(columns=MEASURES_COLUMNS).reset_index(drop=True)
+    df.insert(0, 'Group', names)
+
+    if bootstrap:
+        intervals = bootstrap_intervals(data, column, bootstrap, confidence, seed)
+        df = pd.concat([df, intervals.reset_index(drop=True)], axis=1)
     
     return df
 
 def find_outliers(data, column='Retrieval Time (ms)'):
-    # DataFrame for concatenating all groups
-    df = pd.DataFrame()
+    data, _, stats, codes, outliers, _ = split_outliers(data, column)
 
-    for name, group in data:
-        name = bytes_to_size(name)
+    positions = group_positions(codes, outliers)
+    df = data.obj.iloc[positions]
 
-        print(f"Finding outliers for group: {name}")
-        Q1 = group[column].quantile(0.25)
-        Q3 = group[column].quantile(0.75)
-        IQR = Q3 - Q1
-        outlier_step = 1.5 * IQR
-        print('Lower outlier gate:', Q1 - outlier_step)
-        print('Upper outlier gate:', Q3 + outlier_step)
-        outliers = group[(group[column] < Q1 - outlier_step) | (group[column] > Q3 + outlier_step)]
-        df = pd.concat([df, outliers])
-        print('Outliers for the dataset are:', outliers)
+    # Printing the outliers of every group costs more than finding them, so only when asked for
+    if logger.isEnabledFor(logging.DEBUG):
+        for code, name in enumerate(stats.index):
+            logger.debug('Finding outliers for group: %s', bytes_to_size(name))
+            logger.debug('Lower outlier gate: %s', stats['Lower gate'].iat[code])
+            logger.debug('Upper outlier gate: %s', stats['Upper gate'].iat[code])
+            logger.debug('Outliers for the dataset are: %s', df[codes[positions] == code])
 
     df = df.reset_index()
     return df
     
 
-def remove_outliers_from_group(data, column='Retrieval Time (ms)'):
-    Q1 = data[column].quantile(0.25)
-    Q3 = data[column].quantile(0.75)
-    IQR = Q3 - Q1
-    outlier_step = 1.5 * IQR
-    data_clean = data[(data[column] >= Q1 - outlier_step) & (data[column] <= Q3 + outlier_step)]
+def remove_outliers_from_group(data, column='Retrieval Time (ms)', method='iqr'):
+    # The whole DataFrame as a single group
+    groups = outliers.sort_groups(data.groupby(np.zeros(len(data), dtype=int)), column)
+    (lower,), (upper,) = outliers.gates(groups, method)
+    data_clean = data[(data[column] >= lower) & (data[column] <= upper)]
 
     data_clean = data_clean.reset_index()
     return data_clean
 
-def remove_outliers(data, column='Retrieval Time (ms)'):
-    # DataFrame for concatenating all groups
-    data_clean = pd.DataFrame()
+def remove_outliers(data, column='Retrieval Time (ms)', message='Removing outliers for group:'):
+    data, _, stats, codes, _, inliers = split_outliers(data, column)
 
-    for name, group in data:
-        name = bytes_to_size(name)
+    if logger.isEnabledFor(logging.DEBUG):
+        for name in stats.index:
+            logger.debug('%s %s', message, bytes_to_size(name))
 
-        print(f"Removing outliers for group: {name}")
-        group_clean = remove_outliers_from_group(group, column)
-        data_clean = pd.concat([data_clean, group_clean])
+    data_clean = data.obj.iloc[group_positions(codes, inliers)]
 
+    data_clean = data_clean.reset_index()
     return data_clean
 
 def remove_outliers_and_average(data, column='Retrieval Time (ms)'):
+    data, _, stats, codes, _, inliers = split_outliers(data, column)
+
+    # Mean of the rows within the gates, NaN for groups left without any
+    clean_average = data.obj[column].to_numpy()[inliers]
+    clean_average = pd.Series(clean_average).groupby(codes[inliers]).mean().reindex(range(len(stats)))
+
     rows = []
-    for name, group in data:
+    for name, average, average_clean in zip(stats.index, stats['mean'], clean_average):
         name = bytes_to_size(name)
 
-        print(f"Removing outliers and finding average for group: {name}")
+        logger.debug('Removing outliers and finding average for group: %s', name)
 
         cols = []
 
-        average = group[column].mean()
         message = f"Size: {name} Average value (with outliers) is: {average}"
         cols.append(message)
-        print(message)
+        logger.debug(message)
 
-        data_clean = remove_outliers_from_group(group, column)
-
-        average = data_clean[column].mean()
-        message = f"Average value (excluding outliers) is: {average}"
+        message = f"Average value (excluding outliers) is: {average_clean}"
         cols.append(message)
-        print(message)
+        logger.debug(message)
 
         rows.append(cols)
     
     return rows
 
 def remove_outliers_and_boxplot(data, column='Retrieval Time (ms)'):
-    # DataFrame for concatenating all groups
-    data_clean = pd.DataFrame()
-
-    for name, group in data:
-        name = bytes_to_size(name)
-
-        print(f"Removing outliers and plotting boxplot: {name}")
-        group_clean = remove_outliers_from_group(group, column)
-        data_clean = pd.concat([data_clean, group_clean])
+    data_clean = remove_outliers(data, column, message='Removing outliers and plotting boxplot:')
 
     return plot_boxplot(data_clean)
 
-def remove_outliers_and_find_measures(data, column='Retrieval Time (ms)'):
-    clean_data = pd.DataFrame()
-    size_diff = {}
-    
-    for name, group in data:
-        name = bytes_to_size(name)
+def remove_outliers_and_find_measures(data, column='Retrieval Time (ms)', bootstrap=0, confidence=0.95, seed=None):
+    data, _, stats, codes, _, inliers = split_outliers(data, column)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        for name in stats.index:
+            logger.debug('Removing outliers and finding measures: %s', bytes_to_size(name))
 
-        print(f"Removing outliers and finding measures: {name}")
-        group_clean = remove_outliers_from_group(group, column)
-        
-        size_diff[name] = len(group) - len(group_clean)
-        clean_data = pd.concat([clean_data, group_clean])
+    clean_data = data.obj.iloc[group_positions(codes, inliers)]
+    removed = stats['size'].to_numpy() - np.bincount(codes[inliers], minlength=len(stats))
+    size_diff = dict(zip(map(bytes_to_size, stats.index), removed))
     
-    measures_df = find_measures(clean_data.groupby('Size (Bytes)'))
+    measures_df = find_measures(clean_data.groupby('Size (Bytes)'), column, bootstrap, confidence, seed)
     measures_df['Outliers'] = measures_df['Group'].map(size_diff)
 
     return measures_df
 
+def compare_outlier_methods(data, column='Retrieval Time (ms)', methods=outliers.DEFAULT_METHODS):
+    # The gates, outliers and clean mean and median of every group under every method, all
+    # from one sort of the groups
+    flags, group_gates, groups = outliers.outlier_flags(data, column, methods)
+    names = data.size().index
+    sizes = np.bincount(groups.codes, minlength=len(names))
+
+    frames = []
+    for method in methods:
+        # In the sorted order, so the clean values of every group are still sorted
+        outlier_rows = flags[method].to_numpy()[groups.order]
+        clean_codes = groups.codes[~outlier_rows]
+        clean_values = groups.values[~outlier_rows]
+
+        clean_sizes = np.bincount(clean_codes, minlength=len(names))
+        ends = np.cumsum(clean_sizes)
+        clean = outliers.SortedGroups(clean_values, None, clean_codes, ends - clean_sizes, ends)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            clean_mean = np.bincount(clean_codes, clean_values, minlength=len(names)) / clean_sizes
+            ratio = 100 * (sizes - clean_sizes) / sizes
+
+        frames.append(pd.DataFrame({
+            'Code': np.arange(len(names)),
+            'Group': [bytes_to_size(name) for name in names],
+            'Method': method,
+            'Lower gate': group_gates[method][0],
+            'Upper gate': group_gates[method][1],
+            'Group size': sizes,
+            'Outliers': sizes - clean_sizes,
+            'Outlier ratio (%)': ratio,
+            'Clean mean': clean_mean,
+            'Clean median': outliers.quantiles(clean, 0.5)
+        }))
+
+    df = pd.concat(frames, ignore_index=True).sort_values('Code', kind='stable')
+    return df.drop(columns='Code').reset_index(drop=True)
+
+# Let the stage scheduler share one split_outliers stage between these functions
+for function in [find_measures, find_outliers, remove_outliers, remove_outliers_and_average, remove_outliers_and_boxplot, remove_outliers_and_find_measures]:
+    function.shared_stage = split_outliers
+
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return [os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns]
+
+def parse_csv(file_path, na_values='-'):
+    data = pd.read_csv(file_path, na_values=na_values, dtype=COLUMN_TYPES)
+    if 'Date' in data:
+        data['Date'] = pd.to_datetime(data['Date'], format=DATE_FORMAT)
+
+    return data
+
+def configure_reading(workers=None, read_ahead=None):
+    # workers: number of read threads, 0 reads the files when they are used.
+    # read_ahead: files being read or waiting to be used at once.
+    global READ_WORKERS, READ_AHEAD
+
+    if workers is not None:
+        READ_WORKERS = workers
+    if read_ahead is not None:
+        READ_AHEAD = max(1, read_ahead)
+
+def prefetch(file_path, na_values='-'):
+    # Start reading the file in the read pool, the next read_records of it gets the result
+    global read_pool
+
+    if read_pool is None:
+        read_pool = ThreadPoolExecutor(READ_WORKERS, thread_name_prefix='read')
+
+    slot = (os.path.abspath(file_path), na_values)
+    if slot not in prefetched:
+        prefetched[slot] = read_pool.submit(load_records, file_path, na_values)
+
+    return slot
+
+def read_ahead(items, key=None, na_values='-'):
+    # Yield the items (file paths, or anything key maps to a path) in order while the files of the next
+    # ones are read by the read pool, at most READ_AHEAD files ahead. The items come from a generator,
+    # e.g. a walk, listing the directories while the files are read. The caller reads every file as usual
+    # (read_all, read_columns...) and gets the prefetched records. Items whose key is None aren't
+    # prefetched, and prefetched files their caller didn't read are dropped.
+    key = key or (lambda item: item)
+    if READ_WORKERS < 1:
+        yield from items
+        return
+
+    items = iter(items)
+    window = []
+
+    try:
+        while True:
+            # Keep READ_AHEAD files read or being read, listing more of the items as needed
+            for item in itertools.islice(items, READ_AHEAD - len(window)):
+                file_path = key(item)
+                window.append((item, None if file_path is None else prefetch(file_path, na_values)))
+
+            if not window:
+                return
+
+            item, slot = window.pop(0)
+            try:
+                yield item
+            finally:
+                # Dropped if the caller didn't read it
+                if slot is not None:
+                    prefetched.pop(slot, None)
+    finally:
+        for _, slot in window:
+            future = prefetched.pop(slot, None) if slot is not None else None
+            if future is not None:
+                future.cancel()
+
+def keep_records_in_memory(enabled=True):
+    global records_memory
+    records_memory = {} if enabled else None
+
+def read_records(file_path, na_values='-'):
+    # Parse a CSV file into properly typed columns, taking the result of its read if read_ahead()
+    # prefetched it. Read errors are raised here either way.
+    future = prefetched.pop((os.path.abspath(file_path), na_values), None)
+    if future is not None:
+        return future.result()
+
+    return load_records(file_path, na_values)
+
+def load_records(file_path, na_values='-'):
+    # The parsed DataFrame is cached on disk, and in memory once keep_records_in_memory() is called,
+    # and reused for as long as the file keeps the same path, size and modification time.
+    fingerprint = file_fingerprint(file_path) + [na_values]
+    if records_memory is None:
+        return read_cached_records(file_path, fingerprint, na_values)
+
+    entry = records_memory.get(fingerprint[0])
+    if entry is None or entry['fingerprint'] != fingerprint:
+        entry = {'fingerprint': fingerprint, 'data': read_cached_records(file_path, fingerprint, na_values)}
+        records_memory[fingerprint[0]] = entry
+
+    # Callers modify the frame in place (dropna, tag columns), so each gets a copy
+    return entry['data'].copy()
+
+def read_cached_records(file_path, fingerprint, na_values='-'):
+    if CACHE_DIR is None:
+        return parse_csv(file_path, na_values)
+
+    cache_file = os.path.join(CACHE_DIR, hashlib.sha1(fingerprint[0].encode()).hexdigest() + '.pkl')
+
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['fingerprint'] == fingerprint:
+            return cached['data']
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    data = parse_csv(file_path, na_values)
+
+    # Write to a temporary file first, so that an interrupted run never leaves a broken entry
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'fingerprint': fingerprint, 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+    return data
+
 def read_all(file_path, dropna=True, na_values='-'):
-    data = pd.read_csv(file_path, na_values=na_values)
+    data = read_records(file_path, na_values=na_values)
     if dropna:
         data.dropna(inplace=True) # drop na values
     
     return data
 
 def read_columns(file_path, columns=['Retrieval Time (ms)', 'Size (Bytes)'], dropna=True, na_values='-'):
-    data = pd.read_csv(file_path, usecols=columns, na_values=na_values)
+    data = read_records(file_path, na_values=na_values)[columns]
     if dropna:
         data.dropna(inplace=True) # drop na values
     
@@ -234,7 +835,8 @@ def read_columns_and_groupby(file_path, groupby='Size (Bytes)', groupby_type=int
 def read_columns_groupby_and_filter(file_path, groupby='Size (Bytes)', groupby_type=int, columns=['Retrieval Time (ms)', 'Size (Bytes)'], dropna=True, na_values='-'):
     data = read_columns(file_path, columns=columns, dropna=dropna, na_values=na_values)
     
-    print('Will remove', data[data['Retrieval Time (ms)'] > 15000])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Will remove %s', data[data['Retrieval Time (ms)'] > 15000])
 
     # Keep only values smaller than 15 seconds
     data = data[data['Retrieval Time (ms)'] <= 15000]
@@ -251,19 +853,27 @@ def save_fig(fig, directory, file_name):
     os.makedirs(directory, exist_ok=True)
     file_name = os.path.join(directory, file_name)
 
-    fig.savefig(f'{file_name}.png')
+    submit_render(fig, f'{file_name}.png')
+
+    return [f'{file_name}.png']
 
 def save_figs(figs, directory, file_name):
     os.makedirs(directory, exist_ok=True)
     file_name = os.path.join(directory, file_name)
 
+    paths = []
     for fig in figs:
-        fig.savefig(f'{file_name}_{fig.name}.png')
+        submit_render(fig, f'{file_name}_{fig.name}.png')
+        paths.append(f'{file_name}_{fig.name}.png')
+
+    return paths
 
 def save_csv(df, directory, file_name):
     os.makedirs(directory, exist_ok=True)
     file_name = os.path.join(directory, file_name)
-    df.to_csv(f'{file_name}_.csv', index=False)
+    df.to_csv(f'{file_name}_.csv', index=False, date_format=DATE_FORMAT)
+
+    return [f'{file_name}_.csv']
 
 def write_to_txt(data, directory, file_name):
     os.makedirs(directory, exist_ok=True)
@@ -275,50 +885,248 @@ def write_to_txt(data, directory, file_name):
             line = ', '.join(map(str, row))
             f.write(line + '\n')
 
-def process_csv_files(root_dir, column, functions):
+    return [file_name]
+
+def store_csv(df, directory, file_name):
+    # save_csv into the output store
+    return output_store.add('csv', df, directory, file_name)
+
+def store_txt(data, directory, file_name):
+    # write_to_txt into the output store
+    return output_store.add('txt', data, directory, file_name)
+
+# Writers of the output store replacing the per-file ones
+STORE_WRITERS = {
+    save_csv: store_csv,
+    write_to_txt: store_txt
+}
+
+def use_output_store(functions):
+    # A copy of the functions list writing its tables into the output store
+    functions = [dict(func_info) for func_info in functions]
+    for func_info in functions:
+        if func_info.get('output_function') in STORE_WRITERS:
+            func_info['output_function'] = STORE_WRITERS[func_info['output_function']]
+
+    return functions
+
+def use_outlier_method(functions, method):
+    # A copy of the functions list splitting the outliers with the method, checked here rather than in every file
+    outliers.parse_method(method)
+    functions = [dict(func_info) for func_info in functions]
+    for func_info in functions:
+        if getattr(func_info['function'], 'shared_stage', None) is split_outliers:
+            func_info['shared_kwargs'] = {'method': method}
+
+    return functions
+
+def use_stats_only(functions):
+    # A copy of the functions list without the entries drawing figures, so the plotting libraries are never imported
+    return [dict(func_info) for func_info in functions if func_info.get('output_function') not in [save_fig, save_figs]]
+
+def use_small_multiples(functions):
+    # A copy of the functions list drawing the histograms of all the sizes in one figure per file or scope
+    functions = [dict(func_info) for func_info in functions]
+    for func_info in functions:
+        if func_info['function'] is plot_distribution:
+            func_info['function'] = plot_distribution_grid
+            func_info['output_function'] = save_fig
+
+    return functions
+
+def process_csv_file(file_path, functions, output_dir_root, name, manifest_dir=None, inputs=None, manifest_records=None, manifests=None):
+    # When the manifest directory is given, outputs whose input and spec match the manifest are not recomputed.
+    # With a manifest_records list, the manifest entries of the new outputs are appended to it instead of saved.
+    # With a manifests dict ({manifest_dir: manifest}, shared by the files of a tree) they are recorded into
+    # it and left for the caller to save, otherwise the manifest is saved once the file is processed.
+    incremental = manifest_dir is not None
+    if incremental:
+        if manifests is None:
+            outputs_manifest = manifest.load_manifest(manifest_dir)
+        else:
+            if manifest_dir not in manifests:
+                manifests[manifest_dir] = manifest.load_manifest(manifest_dir)
+            outputs_manifest = manifests[manifest_dir]
+
+    pending = []
+    for func_info in functions:
+        key = spec = None
+
+        if incremental and 'output_dir' in func_info:
+            key = manifest.output_key(manifest_dir, os.path.join(output_dir_root, func_info['output_dir']), name)
+            spec = manifest.spec_signature(func_info)
+
+            if manifest.is_up_to_date(outputs_manifest, manifest_dir, key, inputs, spec):
+                logger.info('\tUp to date: %s', key)
+                continue
+
+        pending.append((func_info, key, spec))
+
+    def output(index, data):
+        func_info, key, spec = pending[index]
+
+        if 'output_function' in func_info:
+            output_function = func_info['output_function']
+
+            if 'output_dir' in func_info:
+                output_dir = os.path.join(output_dir_root, func_info['output_dir'])
+            outputs = instrument.call(f"{output_function.__name__}:{func_info['output_dir']}", 'output', output_function, data, output_dir, name)
+
+            if key is None:
+                return
+
+            if manifest_records is not None:
+                manifest_records.append((manifest_dir, key, inputs, spec, outputs))
+            else:
+                manifest.record(outputs_manifest, manifest_dir, key, inputs, spec, outputs)
+
+    # Entries with the same data_load_function and args load and group the file only once
+    dag = stages.compile_stages([func_info for func_info, _, _ in pending])
+    try:
+        stages.run_stages(dag, file_path, output)
+    finally:
+        # Once per file rather than after every output, keeping what was written if a function fails
+        if incremental and manifest_records is None and manifests is None and pending:
+            manifest.save_manifest(outputs_manifest, manifest_dir)
+
+def process_csv_file_job(file_path, functions, output_dir_root, name, manifest_dir=None, inputs=None):
+    # process_csv_file in a worker process. Every file of a processed tree shares its manifest, so the
+    # entries are handed back to the parent with the instrumentation events instead of saved here.
+    manifest_records = []
+    with instrument.span(file_path, 'file'):
+        process_csv_file(file_path, functions, output_dir_root, name, manifest_dir, inputs, manifest_records)
+        finish_rendering()
+        output_store.flush()
+
+    return manifest_records, instrument.take_events()
+
+def remove_outputs(manifest_dir, stale):
+    # Delete the outputs of the manifest whose key is stale, e.g. those of a CSV that was removed since,
+    # and forget them. Outputs in the output store share their segments, they are discarded from it instead.
+    outputs_manifest = manifest.load_manifest(manifest_dir)
+    keys = [key for key in outputs_manifest if stale(key)]
+
+    for key in keys:
+        logger.info('\tRemoving outputs: %s', key)
+        for path in outputs_manifest.pop(key)['outputs']:
+            path = os.path.join(manifest_dir, path)
+
+            if os.path.abspath(path).startswith(os.path.abspath(output_store.STORE_DIR) + os.sep):
+                output_store.discard(os.path.join(manifest_dir, os.path.dirname(key)), os.path.basename(key))
+            elif os.path.exists(path):
+                os.remove(path)
+                try:
+                    # The directories it leaves empty, up to the tree and its manifest
+                    os.removedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+
+    if keys:
+        manifest.save_manifest(outputs_manifest, manifest_dir)
+
+def csv_files(root_dir):
+    # (directory, file name) of every CSV under root_dir that process_csv_files processes, in walk order
     for dirName, subdirList, fileList in os.walk(root_dir):
-        print('Found directory:', dirName)
         found_csv_foler = False
 
         for fname in fileList:
             if fname.endswith('.csv'):
-                print('\tProcessing file:', fname)
-                file_path = os.path.join(dirName, fname)
                 found_csv_foler = True
-                
-                #for each function load data and execute function
-                for func_info in functions:
-                    function = func_info['function']
-                    data_load_function = func_info['data_load_function']
-                    args = func_info['args']
-
-                    data = data_load_function(file_path, *args)
-                    if 'data_process_function' in func_info:
-                        process_function = func_info['data_process_function']
-                        data = process_function(data)
-                    
-                    data = function(data)
-                    
-                    if 'output_function' in func_info:
-                        output_function = func_info['output_function']
-
-                        if 'output_dir' in func_info:
-                            output_dir = func_info['output_dir']
-                            parent_dir = os.path.dirname(dirName)
-                            grand_parent_dir = os.path.dirname(dirName)
-                            output_dir = os.path.join(os.path.dirname(grand_parent_dir), os.path.basename(parent_dir) + '_processed_by_experiment_and_client', os.path.basename(dirName), output_dir)
-                        name, ext = os.path.splitext(fname)
-                        output_function(data, output_dir, name)
-        
+                yield dirName, fname
+
         #  We need to process only the initial csv files. So we should prevent os.walk
         #  from descending deeper into the directory's structure after the first csv is found.
         if found_csv_foler:
             del subdirList[:]
 
-
-if __name__ == "__main__":
-    # List of functions to apply
-    functions = [
+def csv_file_tasks(root_dir, functions, incremental=False, files=None):
+    # The process_csv_file arguments of every CSV under root_dir, as the walk finds them.
+    # files: only these CSVs (e.g. the ones that just changed), every CSV by default.
+    if files is not None:
+        files = {os.path.normpath(file_path) for file_path in files}
+
+    for dirName, fname in csv_files(root_dir):
+        if files is not None and os.path.normpath(os.path.join(dirName, fname)) not in files:
+            continue
+
+        parent_dir = os.path.dirname(dirName)
+        grand_parent_dir = os.path.dirname(dirName)
+        processed_dir = os.path.join(os.path.dirname(grand_parent_dir), os.path.basename(parent_dir) + '_processed_by_experiment_and_client')
+
+        file_path = os.path.join(dirName, fname)
+        name, ext = os.path.splitext(fname)
+        inputs = manifest.inputs_signature({file_path: file_fingerprint(file_path)}) if incremental else None
+        yield file_path, functions, os.path.join(processed_dir, os.path.basename(dirName)), name, processed_dir if incremental else None, inputs
+
+def file_to_read(task, manifests):
+    # The file of a process_csv_file task, None if all its outputs are up to date and it won't be read
+    file_path, functions, output_dir_root, name, manifest_dir, inputs = task
+    if manifest_dir is None:
+        return file_path
+
+    if manifest_dir not in manifests:
+        manifests[manifest_dir] = manifest.load_manifest(manifest_dir)
+
+    outputs_manifest = manifests[manifest_dir]
+    for func_info in functions:
+        if 'output_dir' not in func_info:
+            return file_path
+
+        key = manifest.output_key(manifest_dir, os.path.join(output_dir_root, func_info['output_dir']), name)
+        if not manifest.is_up_to_date(outputs_manifest, manifest_dir, key, inputs, manifest.spec_signature(func_info)):
+            return file_path
+
+    return None
+
+def process_csv_files(root_dir, column, functions, incremental=False, jobs=1, files=None):
+    # With several jobs the files are spread over a pool of processes, each drawing its own figures.
+    # Serially, the files are read ahead by the read pool while the previous ones are processed.
+    if incremental:
+        # The outputs (<experiment>/<output_dir>/<name>) of the CSVs that no longer exist
+        remove_outputs(os.path.normpath(root_dir) + '_processed_by_experiment_and_client',
+                       lambda key: not os.path.exists(os.path.join(root_dir, key.split(os.sep)[0], os.path.basename(key) + '.csv')))
+
+    tasks = csv_file_tasks(root_dir, functions, incremental, files)
+
+    if jobs <= 1:
+        # The manifest of the tree is loaded once, shared by its files and saved once at the end,
+        # like the pool does below
+        manifests = {}
+        tasks = read_ahead(tasks, key=lambda task: file_to_read(task, manifests))
+
+        try:
+            # In walk order, so that the files of a directory are processed together
+            for dirName, group in itertools.groupby(tasks, key=lambda task: os.path.dirname(task[0])):
+                logger.info('Found directory: %s', dirName)
+                with instrument.span(dirName, 'directory'):
+                    for task in group:
+                        logger.info('\tProcessing file: %s', os.path.basename(task[0]))
+                        with instrument.span(task[0], 'file'):
+                            process_csv_file(*task, manifests=manifests)
+        finally:
+            for manifest_dir, outputs_manifest in manifests.items():
+                manifest.save_manifest(outputs_manifest, manifest_dir)
+        return
+
+    manifests = {}
+    with ProcessPoolExecutor(jobs, initializer=configure_rendering, initargs=(0,)) as pool:
+        futures = {pool.submit(process_csv_file_job, *task): task[0] for task in tasks}
+
+        for future in as_completed(futures):
+            manifest_records, events = future.result()
+            instrument.add_events(events)
+            logger.info('\tProcessed file: %s', futures[future])
+
+            for manifest_dir, key, inputs, spec, outputs in manifest_records:
+                if manifest_dir not in manifests:
+                    manifests[manifest_dir] = manifest.load_manifest(manifest_dir)
+                manifest.record(manifests[manifest_dir], manifest_dir, key, inputs, spec, outputs)
+
+    for manifest_dir, outputs_manifest in manifests.items():
+        manifest.save_manifest(outputs_manifest, manifest_dir)
+
+# List of functions to apply
+FUNCTIONS = [
     {
         'function': plot_distribution,
         'data_load_function': read_columns_and_groupby,
@@ -375,15 +1183,86 @@ if __name__ == "__main__":
         'output_function': save_csv,
         'output_dir': 'data_grouped'
     }
-    ]
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true', help='regenerate every output, ignoring the manifests')
+    parser.add_argument('--render-workers', type=int, default=os.cpu_count(), help='processes drawing the figures, 0 to draw them serially')
+    parser.add_argument('--max-open-figures', type=int, default=MAX_OPEN_FIGURES, help='figures queued or being drawn at once')
+    parser.add_argument('--jobs', type=int, default=1, help='processes computing the files in parallel, each drawing its own figures')
+    parser.add_argument('--read-workers', type=int, default=READ_WORKERS, help='threads reading the CSVs ahead of their processing, 0 to read each one when it is used')
+    parser.add_argument('--read-ahead', type=int, default=READ_AHEAD, help='CSVs read or being read ahead at once')
+    parser.add_argument('--stage-workers', type=int, default=stages.WORKERS, help='threads running independent stages of the functions list at once')
+    parser.add_argument('--bootstrap', type=int, default=0, help='resamples for the confidence intervals of the mean and median in the measures, 0 to skip them')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the bootstrap intervals')
+    parser.add_argument('--seed', type=int, help='seed of the bootstrap resampling')
+    parser.add_argument('--outlier-method', metavar='METHOD', help="method of the outlier removal, e.g. 'iqr:k=3', 'mad:z=3.5', 'percentile:low=1,high=99' or 'cutoff:high=15000'")
+    parser.add_argument('--outlier-methods', metavar='METHOD', nargs='+', help='also compare these outlier methods on every group, writing the outlier_methods tables')
+    parser.add_argument('--engine', default='pandas', choices=['pandas', 'sql'], help='sql computes the measures, outliers and grouped data as SQL queries over all the files')
+    parser.add_argument('--record-store', action='store_true', help='load the grouped records from the memory-mapped record store, building or updating it first')
+    parser.add_argument('--small-multiples', action='store_true', help='draw the histograms of all the sizes in one figure instead of one figure per size')
+    parser.add_argument('--stats-only', action='store_true', help='skip the figures, computing only the tables without loading the plotting libraries')
+    parser.add_argument('--output-mode', default='files', choices=['files', 'store'], help='store collects the tables into the consolidated output store instead of a file each')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='DEBUG also logs the details of every group')
+    parser.add_argument('--instrument', metavar='PREFIX', help='record the time and memory of every stage, writing PREFIX.json and the Chrome trace PREFIX.trace.json')
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level, format='%(message)s')
+    instrument.enable(cli_args.instrument is not None)
+    configure_rendering(cli_args.render_workers, cli_args.max_open_figures)
+    configure_reading(cli_args.read_workers, cli_args.read_ahead)
+    stages.WORKERS = cli_args.stage_workers
+
+    functions = [dict(func_info) for func_info in FUNCTIONS]
+
+    if cli_args.bootstrap:
+        for func_info in functions:
+            if func_info['function'] in [find_measures, remove_outliers_and_find_measures]:
+                func_info['function_kwargs'] = {'bootstrap': cli_args.bootstrap, 'confidence': cli_args.confidence, 'seed': cli_args.seed}
+
+    if cli_args.outlier_method:
+        functions = use_outlier_method(functions, cli_args.outlier_method)
+
+    if cli_args.outlier_methods:
+        functions.append({
+            'function': compare_outlier_methods,
+            'data_load_function': read_columns_and_groupby,
+            'args': [],
+            'function_kwargs': {'methods': cli_args.outlier_methods},
+            'output_function': save_csv,
+            'output_dir': 'outlier_methods'
+        })
+
+    if cli_args.record_store:
+        # Imported here, the record store imports this module itself
+        import record_store
+        record_store.update_store()
+        functions = record_store.use_record_store(functions)
+
+    if cli_args.small_multiples:
+        functions = use_small_multiples(functions)
+
+    if cli_args.stats_only:
+        functions = use_stats_only(functions)
+
+    if cli_args.output_mode == 'store':
+        functions = use_output_store(functions)
 
-    root_dirs = [
-        './accumulated_csv_records/11-06 & 12-06 & 16-06 - 18-06/ipfs/retrieve',
-        './accumulated_csv_records/miletus_degroot_nancy/19-06-2023/ipfs/retrieve',
-        './accumulated_csv_records/13-06 & 18-06/swarm/retrieve'
-    ]
     column = 'Retrieval Time (ms)'
 
-    for root_dir in root_dirs:
-        process_csv_files(root_dir, column, functions)
+    for root_dir in ROOT_DIRS:
+        root_functions = functions
+        if cli_args.engine == 'sql':
+            # Imported here, the SQL engine imports this module itself
+            import sql_backend
+            root_functions = sql_backend.process_csv_files(root_dir, column, functions, incremental=not cli_args.full)
+
+        process_csv_files(root_dir, column, root_functions, incremental=not cli_args.full, jobs=cli_args.jobs)
+        output_store.flush()
+
+    finish_rendering()
+
+    if cli_args.instrument:
+        instrument.save(cli_args.instrument)
 
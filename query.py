@@ -0,0 +1,119 @@
+import os
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+
+import process_results as results
+import records_index
+import sketches
+
+# Per file and per size mergeable summaries of every indexed CSV, kept up to date with the index
+AGGREGATES_FILE = os.path.join(results.CACHE_DIR or '.records_cache', 'summaries.pkl')
+
+STATS = {
+    'count': 'size',
+    'mean': 'mean',
+    'std': 'std',
+    'median': 'median',
+    'var': 'var',
+    'skew': 'skew',
+    'min': 'min',
+    'max': 'max',
+    'q1': 'Q1',
+    'q3': 'Q3'
+}
+
+def file_aggregates(file_path, column='Retrieval Time (ms)'):
+    return sketches.summarize_groups(results.read_columns_and_groupby(file_path, columns=[column, 'Size (Bytes)']), column)
+
+def load_aggregates(aggregates_file=AGGREGATES_FILE):
+    try:
+        with open(aggregates_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+def update_aggregates(index, aggregates_file=AGGREGATES_FILE):
+    # {path: (modified, {size: Summary})}, only files that changed since they were aggregated are read
+    store = load_aggregates(aggregates_file)
+    changed = False
+
+    for path, modified in zip(index['Path'], index['Modified']):
+        entry = store.get(path)
+        if entry is None or entry[0] != modified:
+            store[path] = (modified, file_aggregates(path))
+            changed = True
+
+    for path in set(store) - set(index['Path']):
+        del store[path]
+        changed = True
+
+    if changed:
+        os.makedirs(os.path.dirname(aggregates_file) or '.', exist_ok=True)
+        tmp_file = f'{aggregates_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, aggregates_file)
+
+    return store
+
+def raw_statistic(paths, stat, column='Retrieval Time (ms)', clean=False):
+    # Compute the statistic from the (cached) records of the files. The outliers are those of the
+    # whole slice, as in the measures_clean of a scope and the tables of a host.
+    data = pd.concat([results.read_columns(path, columns=[column, 'Size (Bytes)']) for path in paths], ignore_index=True)
+    data['Size (Bytes)'] = data['Size (Bytes)'].astype(int)
+    grouped = data.groupby('Size (Bytes)')
+
+    if clean:
+        grouped = results.remove_outliers(grouped, column).groupby('Size (Bytes)')
+
+    return results.group_statistics(grouped, column)[STATS[stat]]
+
+def select_paths(index, **criteria):
+    files = records_index.select_files(index, **{key: value for key, value in criteria.items() if value is not None})
+    return list(files['Path'])
+
+def query(backend=None, experiment=None, client=None, size=None, stat='median', campaign=None, host=None, clean=False, column='Retrieval Time (ms)'):
+    # e.g. query(backend='ipfs', experiment='do-not-cache', client='grenoble', size='1MB', stat='median')
+    # Returns the statistic for the given size, or a Series with one value per size
+    if stat not in STATS:
+        raise ValueError(f'Unknown statistic {stat}, expected one of {", ".join(STATS)}')
+
+    index = records_index.update_index()
+    paths = select_paths(index, backend=backend, experiment=experiment, site=client, campaign=campaign, host=host)
+
+    # Removing outliers needs the rows themselves, everything else merges from the summaries
+    if column != 'Retrieval Time (ms)' or clean:
+        values = raw_statistic(paths, stat, column, clean) if paths else pd.Series(dtype=float)
+    else:
+        store = update_aggregates(index)
+        summaries = sketches.merge_groups([store[path][1] for path in paths])
+        values = sketches.statistics_frame(summaries)[STATS[stat]] if summaries else pd.Series(dtype=float)
+
+    values = values.rename(stat)
+    if size is None:
+        return values
+
+    return values.get(results.size_to_bytes(size), np.nan)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Answer statistics about a slice of the CSV records')
+    parser.add_argument('--backend')
+    parser.add_argument('--experiment')
+    parser.add_argument('--client', help='site of the client, e.g. grenoble or degroot')
+    parser.add_argument('--campaign')
+    parser.add_argument('--host')
+    parser.add_argument('--size', help='e.g. 1MB or 1048576, all sizes if omitted')
+    parser.add_argument('--stat', default='median', choices=list(STATS))
+    parser.add_argument('--clean', action='store_true', help='remove the outliers of the selected records before computing the statistic')
+    cli_args = parser.parse_args()
+
+    value = query(cli_args.backend, cli_args.experiment, cli_args.client, cli_args.size, cli_args.stat, cli_args.campaign, cli_args.host, cli_args.clean)
+
+    if isinstance(value, pd.Series):
+        value.index = value.index.map(results.bytes_to_size)
+        print(value.to_string())
+    else:
+        print(value)
@@ -0,0 +1,291 @@
+import os
+import shutil
+import pickle
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+import process_results as results
+import records_index
+
+logger = logging.getLogger(__name__)
+
+# Every record of the index in one set of fixed-width columns (one .npy each), memory-mapped and
+# sorted by campaign, backend, operation, experiment, host and size, each file's rows keeping their
+# order within a size and its NA rows coming last. The offsets of every file and of every size within
+# it are kept in store.pkl, so a file's groups are zero-copy slices of the columns and only the pages
+# of the records actually used are ever read.
+STORE_DIR = os.environ.get('RECORD_STORE_DIR', os.path.join(results.CACHE_DIR or '.records_cache', 'record_store'))
+METADATA_FILE = 'store.pkl'
+
+# process_folders ingests the records from the store instead of their CSVs, see enable()
+ENABLED = bool(os.environ.get('RECORD_STORE'))
+
+SORT_COLUMNS = ['Campaign', 'Backend', 'Operation', 'Experiment', 'Host', 'Path']
+
+# (array, dtype) of every column, Int64 columns have a mask of their NAs too
+ARRAYS = {
+    'row': np.int64,
+    'date': np.int64,
+    'time': np.float64,
+    'repo': np.int64,
+    'repo_na': np.bool_,
+    'type': np.int16,
+    'size': np.int64,
+    'size_na': np.bool_,
+    # Position in the store of every row of a file, in file order
+    'order': np.int64
+}
+
+# {'metadata', 'arrays'} of the open store
+opened = None
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def file_arrays(data, types):
+    # The columns of one parsed CSV as the store's arrays, in file order
+    rows = len(data)
+    arrays = {'row': np.arange(rows, dtype=np.int64)}
+
+    dates = data['Date'] if 'Date' in data else pd.Series(pd.NaT, index=data.index, dtype='datetime64[ns]')
+    arrays['date'] = dates.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    arrays['time'] = data['Retrieval Time (ms)'].to_numpy(dtype=np.float64)
+
+    for array, column in [('repo', 'Size in Repo(Bytes)'), ('size', 'Size (Bytes)')]:
+        values = data[column] if column in data else pd.Series(pd.NA, index=data.index, dtype='Int64')
+        arrays[f'{array}_na'] = values.isna().to_numpy()
+        arrays[array] = values.fillna(0).to_numpy(dtype=np.int64)
+
+    if 'Type' in data:
+        kinds = data['Type'].astype(object)
+        for kind in kinds.dropna().unique():
+            types.setdefault(kind, len(types))
+        arrays['type'] = kinds.map(types).fillna(-1).to_numpy(dtype=np.int16)
+    else:
+        arrays['type'] = np.full(rows, -1, dtype=np.int16)
+
+    return arrays
+
+def build_store(index, store_dir=STORE_DIR):
+    # Write the store of every file in the index into a new directory, replacing the old one at once
+    index = index.sort_values(SORT_COLUMNS, kind='stable').reset_index(drop=True)
+    types = {}
+    parts = {array: [] for array in ARRAYS}
+    offset = 0
+    files = []
+    groups = []
+
+    for entry in results.read_ahead(index.to_dict('records'), key=lambda entry: entry['Path']):
+        data = results.read_records(entry['Path'])
+        arrays = file_arrays(data, types)
+
+        # Sizes in order, each keeping the order of the file, then the NA rows
+        valid = ~(arrays['size_na'] | np.isnan(arrays['time']))
+        order = np.lexsort((arrays['row'], arrays['size'], ~valid))
+        arrays['order'] = np.empty(len(order), dtype=np.int64)
+        arrays['order'][order] = offset + np.arange(len(order))
+        for array in ARRAYS:
+            parts[array].append(arrays[array] if array == 'order' else arrays[array][order])
+
+        sizes, counts = np.unique(arrays['size'][valid], return_counts=True)
+        starts = offset + np.r_[0, np.cumsum(counts)[:-1]]
+        groups += [(len(files), size, start, start + count) for size, start, count in zip(sizes, starts, counts)]
+
+        files.append({
+            'Path': entry['Path'],
+            'Fingerprint': [entry['File size'], entry['Modified']],
+            'Columns': list(data.columns),
+            'Start': offset,
+            'Valid stop': offset + int(valid.sum()),
+            'Stop': offset + len(data)
+        })
+        offset += len(data)
+
+    tmp_dir = f'{store_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    for array, dtype in ARRAYS.items():
+        np.save(os.path.join(tmp_dir, f'{array}.npy'), np.concatenate(parts[array]) if parts[array] else np.empty(0, dtype=dtype))
+
+    files = pd.DataFrame(files, columns=['Path', 'Fingerprint', 'Columns', 'Start', 'Valid stop', 'Stop'])
+    metadata = {
+        'inputs': {entry['Path']: [entry['File size'], entry['Modified']] for entry in index.to_dict('records')},
+        'files': pd.concat([index[SORT_COLUMNS[:-1] + ['Site']], files], axis=1),
+        'groups': pd.DataFrame(groups, columns=['File', 'Size (Bytes)', 'Start', 'Stop']),
+        'types': list(types),
+        'arrays': list(ARRAYS)
+    }
+    with open(os.path.join(tmp_dir, METADATA_FILE), 'wb') as f:
+        pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Processes that still have the old arrays mapped keep reading them until they close the store
+    old_dir = f'{store_dir}.{os.getpid()}.old'
+    if os.path.exists(store_dir):
+        os.replace(store_dir, old_dir)
+    os.replace(tmp_dir, store_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+def load_metadata(store_dir=STORE_DIR):
+    try:
+        with open(os.path.join(store_dir, METADATA_FILE), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def update_store(index=None, store_dir=STORE_DIR):
+    # Rebuild the store when any file of the index was added, changed or removed since it was built
+    global opened
+
+    if index is None:
+        index = records_index.update_index()
+
+    metadata = load_metadata(store_dir)
+    inputs = {entry['Path']: [entry['File size'], entry['Modified']] for entry in index.to_dict('records')}
+
+    if metadata is None or metadata['inputs'] != inputs or metadata.get('arrays') != list(ARRAYS):
+        logger.info('Building the record store of %d files in %s', len(index), store_dir)
+        build_store(index, store_dir)
+        opened = None
+
+    return open_store(store_dir)
+
+def open_store(store_dir=STORE_DIR):
+    # The metadata and memory-mapped arrays of the store, opened once per process
+    global opened
+
+    if opened is None or opened['directory'] != store_dir:
+        metadata = load_metadata(store_dir)
+        if metadata is None:
+            return None
+
+        files = metadata['files']
+        opened = {
+            'directory': store_dir,
+            'metadata': metadata,
+            'files': dict(zip(files['Path'], files.index)),
+            'arrays': {array: np.load(os.path.join(store_dir, f'{array}.npy'), mmap_mode='r') for array in ARRAYS}
+        }
+
+    return opened
+
+def file_entry(file_path, store=None):
+    # The row of the file in the store, None if it isn't in it or has changed since
+    store = store or open_store()
+    if store is None:
+        return None
+
+    position = store['files'].get(os.path.normpath(file_path))
+    if position is None:
+        return None
+
+    entry = store['metadata']['files'].iloc[position]
+    if entry['Fingerprint'] != results.file_fingerprint(file_path)[1:]:
+        return None
+
+    return entry
+
+def column(store, name, start, stop, valid=False):
+    # A column of the rows [start, stop) with the dtype parse_csv gives it, a view of the store's arrays.
+    # valid: the rows have no NAs, so sizes are plain int64 like after astype(int).
+    arrays = store['arrays']
+
+    if name == 'Date':
+        return arrays['date'][start:stop].view('datetime64[ns]')
+    if name == 'Retrieval Time (ms)':
+        return arrays['time'][start:stop]
+    if name == 'Size (Bytes)' and valid:
+        return arrays['size'][start:stop]
+    if name in ['Size (Bytes)', 'Size in Repo(Bytes)']:
+        array = 'size' if name == 'Size (Bytes)' else 'repo'
+        return pd.arrays.IntegerArray(arrays[array][start:stop], arrays[f'{array}_na'][start:stop])
+    if name == 'Type':
+        return pd.Categorical.from_codes(arrays['type'][start:stop], store['metadata']['types'])
+
+    raise KeyError(name)
+
+def read_columns(file_path, columns=['Retrieval Time (ms)', 'Size (Bytes)'], dropna=True, na_values='-'):
+    # results.read_columns from the store, with the rows sorted by size and indexed by their row in
+    # the file. With dropna the frame is a zero-copy view of the store. None if the file isn't stored.
+    store = open_store()
+    entry = file_entry(file_path, store)
+    if entry is None:
+        return None
+
+    stop = entry['Valid stop'] if dropna else entry['Stop']
+    index = pd.Index(store['arrays']['row'][entry['Start']:stop])
+    data = pd.DataFrame({name: column(store, name, entry['Start'], stop, valid=dropna) for name in columns}, index=index, copy=False)
+
+    if dropna:
+        # Only rows with a time and a size are in the valid range, other columns can still be NA
+        others = [name for name in columns if name not in ['Retrieval Time (ms)', 'Size (Bytes)']]
+        if others and data[others].isna().any(axis=None):
+            data = data.dropna()
+    else:
+        data = data.sort_index()
+
+    return data
+
+def read_columns_and_groupby(file_path, groupby='Size (Bytes)', groupby_type=int, columns=['Retrieval Time (ms)', 'Size (Bytes)'], dropna=True, na_values='-'):
+    # Drop-in data_load_function for results.read_columns_and_groupby. Stored sizes are already int64.
+    data = read_columns(file_path, columns=columns, dropna=dropna, na_values=na_values)
+    if data is None:
+        return results.read_columns_and_groupby(file_path, groupby, groupby_type, columns, dropna, na_values)
+
+    if data[groupby].dtype != np.dtype(groupby_type):
+        data[groupby] = data[groupby].astype(groupby_type)
+
+    return data.groupby(groupby)
+
+def use_record_store(functions):
+    # A copy of the functions list loading its grouped data from the store
+    functions = [dict(func_info) for func_info in functions]
+    for func_info in functions:
+        if func_info.get('data_load_function') is results.read_columns_and_groupby:
+            func_info['data_load_function'] = read_columns_and_groupby
+
+    return functions
+
+def read_files(file_paths, columns=None):
+    # All the rows of the files, in file order and one file after the other like concatenating their
+    # parsed CSVs, gathered from the store in one copy per column, and the store entry of every file.
+    # None if any of the files isn't stored.
+    store = open_store()
+    entries = [file_entry(file_path, store) for file_path in file_paths]
+    if not entries or any(entry is None for entry in entries):
+        return None
+
+    if columns is None:
+        columns = []
+        for entry in entries:
+            columns += [name for name in entry['Columns'] if name not in columns]
+
+    positions = np.concatenate([store['arrays']['order'][entry['Start']:entry['Stop']] for entry in entries])
+
+    data = {}
+    for name in columns:
+        values = column(store, name, 0, len(store['arrays']['row']))
+        data[name] = values[positions]
+
+    return pd.DataFrame(data), entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the memory-mapped record store of the CSV records')
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the store even if no file has changed')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level, format='%(message)s')
+
+    index = records_index.update_index()
+    if cli_args.rebuild:
+        build_store(index, cli_args.store_dir)
+
+    store = update_store(index, cli_args.store_dir)
+    rows = len(store['arrays']['row'])
+    size = sum(array.nbytes for array in store['arrays'].values())
+    print(f'{len(store["files"])} files, {len(store["metadata"]["groups"])} groups, {rows} rows, {size} bytes')
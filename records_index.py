@@ -0,0 +1,138 @@
+import os
+import logging
+import argparse
+import pandas as pd
+
+import process_results as results
+
+logger = logging.getLogger(__name__)
+
+# Every CSV under RECORDS_DIR is stored as <campaign>/<backend>/<operation>/<experiment>/<host>.csv,
+# e.g. 13-06 & 18-06/swarm/retrieve/disconnect/graphite-4.nancy.grid5000.fr.csv
+RECORDS_DIR = './accumulated_csv_records'
+# Kept with the cached records, out of the records themselves
+INDEX_FILE = os.path.join(results.CACHE_DIR or '.records_cache', 'index.json')
+
+INDEX_COLUMNS = ['Path', 'Campaign', 'Backend', 'Operation', 'Experiment', 'Host', 'Site', 'Rows', 'NAs', 'Min size', 'Max size', 'First date', 'Last date', 'File size', 'Modified']
+
+def parse_host(fname):
+    # chetemi-9.lille.grid5000.fr.csv -> ('chetemi-9.lille', 'lille'), degroot.csv -> ('degroot', 'degroot')
+    host, _ = os.path.splitext(os.path.basename(fname))
+    host = host.replace('.grid5000.fr', '')
+    site = host.split('.')[-1]
+
+    return host, site
+
+def parse_path(file_path, records_dir=RECORDS_DIR):
+    parts = os.path.relpath(file_path, records_dir).split(os.sep)
+    if len(parts) < 5:
+        return None
+
+    host, site = parse_host(parts[-1])
+    return {
+        'Path': os.path.normpath(file_path),
+        'Campaign': '/'.join(parts[:-4]),
+        'Backend': parts[-4],
+        'Operation': parts[-3],
+        'Experiment': parts[-2],
+        'Host': host,
+        'Site': site
+    }
+
+def find_record_files(records_dir=RECORDS_DIR):
+    for dirName, subdirList, fileList in os.walk(records_dir):
+        # Skip the trees produced by process_folders/process_results
+        subdirList[:] = sorted(subdir for subdir in subdirList if '_processed' not in subdir)
+
+        for fname in sorted(fileList):
+            if fname.endswith('.csv'):
+                yield os.path.join(dirName, fname)
+
+def describe_file(file_path, records_dir=RECORDS_DIR):
+    entry = parse_path(file_path, records_dir)
+    if entry is None:
+        return None
+
+    data = results.read_records(file_path)
+    sizes = data['Size (Bytes)'].dropna()
+    dates = data['Date'].dropna() if 'Date' in data else pd.Series([], dtype='datetime64[ns]')
+    _, file_size, modified = results.file_fingerprint(file_path)
+
+    entry.update({
+        'Rows': len(data),
+        'NAs': int(data['Retrieval Time (ms)'].isna().sum()),
+        'Min size': int(sizes.min()) if len(sizes) else None,
+        'Max size': int(sizes.max()) if len(sizes) else None,
+        'First date': dates.min().strftime(results.DATE_FORMAT) if len(dates) else None,
+        'Last date': dates.max().strftime(results.DATE_FORMAT) if len(dates) else None,
+        'File size': file_size,
+        'Modified': modified
+    })
+    return entry
+
+def load_index(index_file=INDEX_FILE):
+    try:
+        return pd.read_json(index_file, orient='records', dtype=False, convert_dates=False, keep_default_dates=False)[INDEX_COLUMNS]
+    except (OSError, ValueError, KeyError):
+        return pd.DataFrame(columns=INDEX_COLUMNS)
+
+def save_index(index, index_file=INDEX_FILE):
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    tmp_file = f'{index_file}.{os.getpid()}.tmp'
+    index.to_json(tmp_file, orient='records', indent=1)
+    os.replace(tmp_file, index_file)
+
+def update_index(records_dir=RECORDS_DIR, index_file=INDEX_FILE):
+    # Only files that are new or have changed since the last update are read
+    index = load_index(index_file)
+    known = {entry['Path']: entry for entry in index.to_dict('records')}
+
+    entries = []
+    changed = False
+    for file_path in find_record_files(records_dir):
+        entry = known.pop(os.path.normpath(file_path), None)
+        _, file_size, modified = results.file_fingerprint(file_path)
+
+        if entry is None or entry['File size'] != file_size or entry['Modified'] != modified:
+            logger.info('Indexing file: %s', file_path)
+            entry = describe_file(file_path, records_dir)
+            changed = True
+
+        if entry is not None:
+            entries.append(entry)
+
+    # Whatever is left in known has been deleted
+    if changed or known or not os.path.exists(index_file):
+        index = pd.DataFrame(entries, columns=INDEX_COLUMNS)
+        save_index(index, index_file)
+
+    return index
+
+def select_files(index, **criteria):
+    # select_files(index, backend='swarm', experiment='disconnect', site='nancy'),
+    # a list of values matches any of them
+    mask = pd.Series(True, index=index.index)
+    for column, value in criteria.items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        mask &= index[column.capitalize()].isin(values)
+
+    return index[mask]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Update the index of the CSV records and list the files matching the given metadata')
+    parser.add_argument('--records-dir', default=RECORDS_DIR)
+    parser.add_argument('--index-file', default=INDEX_FILE)
+    for column in ['campaign', 'backend', 'operation', 'experiment', 'host', 'site']:
+        parser.add_argument(f'--{column}', action='append')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level, format='%(message)s')
+
+    index = update_index(cli_args.records_dir, cli_args.index_file)
+
+    criteria = {column: values for column, values in vars(cli_args).items() if values and column not in ['records_dir', 'index_file', 'log_level']}
+    selected = select_files(index, **criteria)
+
+    with pd.option_context('display.max_rows', None, 'display.width', None):
+        print(selected.drop(columns=['File size', 'Modified']).to_string(index=False))
@@ -0,0 +1,129 @@
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import process_results as results
+import records_index
+
+# Tidy table with one row per pair of treatments (e.g. backend and experiment), per size and client,
+# written next to the scripts rather than among the records
+SIGNIFICANCE_FILE = 'significance.csv'
+
+TAG_COLUMNS = ['Campaign', 'Backend', 'Operation', 'Experiment', 'Host', 'Site']
+
+def load_records(index, column='Retrieval Time (ms)', extra_columns=[]):
+    # The (cached) records of every file in the index, tagged with the metadata of their file
+    frames = []
+    for entry in results.read_ahead(index.to_dict('records'), key=lambda entry: entry['Path']):
+        data = results.read_columns(entry['Path'], columns=extra_columns + [column, 'Size (Bytes)'])
+        for tag in TAG_COLUMNS:
+            data[tag] = entry[tag]
+        frames.append(data)
+
+    if not frames:
+        raise ValueError('No CSV records match the selection')
+
+    data = pd.concat(frames, ignore_index=True)
+    data['Size (Bytes)'] = data['Size (Bytes)'].astype(int)
+
+    return data
+
+def samples(data, by, strata, column='Retrieval Time (ms)'):
+    # Sort once by (stratum, treatment, value), so that every sample is a sorted slice of the values.
+    # Yields (stratum, {treatment: values}) for every stratum.
+    keys = strata + by
+    data = data.sort_values(keys + [column], kind='stable')
+    values = data[column].to_numpy(dtype=float)
+
+    counts = data.groupby(keys, sort=False).size()
+    bounds = np.r_[0, np.cumsum(counts.to_numpy())]
+    slices = [(key[:len(strata)], key[len(strata):], values[bounds[i]:bounds[i + 1]]) for i, key in enumerate(counts.index)]
+
+    for stratum, group in itertools.groupby(slices, key=lambda item: item[0]):
+        yield stratum, {treatment: values for _, treatment, values in group}
+
+def compare(a, b):
+    u, u_pvalue = stats.mannwhitneyu(a, b, alternative='two-sided')
+    ks, ks_pvalue = stats.ks_2samp(a, b)
+    median_a, median_b = np.median(a), np.median(b)
+
+    return {
+        'N A': len(a),
+        'N B': len(b),
+        'Median A': median_a,
+        'Median B': median_b,
+        'Median difference': median_a - median_b,
+        # P(A > B) - P(A < B), i.e. Cliff's delta: positive when A is usually slower than B
+        'Rank biserial': 2 * u / (len(a) * len(b)) - 1,
+        'U': u,
+        'U p-value': u_pvalue,
+        'KS': ks,
+        'KS p-value': ks_pvalue
+    }
+
+def adjust_pvalues(pvalues):
+    # Benjamini-Hochberg false discovery rate correction
+    pvalues = np.asarray(pvalues, dtype=float)
+    order = np.argsort(pvalues)[::-1]
+    ranks = len(pvalues) - np.arange(len(pvalues))
+
+    adjusted = np.empty_like(pvalues)
+    adjusted[order] = np.minimum(np.minimum.accumulate(pvalues[order] * len(pvalues) / ranks), 1)
+
+    return adjusted
+
+def pairwise_tests(data, by=['Backend', 'Experiment'], strata=['Size (Bytes)', 'Site'], column='Retrieval Time (ms)'):
+    # Mann-Whitney U and Kolmogorov-Smirnov tests of every pair of treatments within every stratum
+    rows = []
+    for stratum, treatments in samples(data, by, strata, column):
+        for (treatment_a, a), (treatment_b, b) in itertools.combinations(treatments.items(), 2):
+            row = dict(zip(strata, stratum))
+            row.update({f'{key} A': value for key, value in zip(by, treatment_a)})
+            row.update({f'{key} B': value for key, value in zip(by, treatment_b)})
+            row.update(compare(a, b))
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+def significance_table(data, by=['Backend', 'Experiment'], column='Retrieval Time (ms)'):
+    # Every pair per size and client, plus per size with the clients pooled (Client 'all')
+    per_client = pairwise_tests(data, by, ['Size (Bytes)', 'Site'], column)
+    pooled = pairwise_tests(data, by, ['Size (Bytes)'], column)
+    if pooled.empty:
+        # A single treatment, nothing to compare
+        return pooled
+
+    pooled.insert(1, 'Site', 'all')
+    table = pd.concat([pooled, per_client], ignore_index=True).rename(columns={'Site': 'Client'})
+
+    for test in ['U', 'KS']:
+        table.insert(table.columns.get_loc(f'{test} p-value') + 1, f'{test} p-value adjusted', adjust_pvalues(table[f'{test} p-value']))
+
+    table.insert(0, 'Size', table.pop('Size (Bytes)').map(results.bytes_to_size))
+
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Test every pair of experiments and backends for significant differences, per size and client')
+    parser.add_argument('--by', nargs='+', default=['Backend', 'Experiment'], choices=TAG_COLUMNS, help='metadata telling the compared treatments apart')
+    parser.add_argument('--output', default=SIGNIFICANCE_FILE)
+    for tag in ['campaign', 'backend', 'operation', 'experiment', 'host', 'site']:
+        parser.add_argument(f'--{tag}', action='append')
+    cli_args = parser.parse_args()
+
+    index = records_index.update_index()
+    criteria = {tag: values for tag, values in vars(cli_args).items() if values and tag not in ['by', 'output']}
+    criteria.setdefault('operation', 'retrieve')
+
+    try:
+        data = load_records(records_index.select_files(index, **criteria))
+    except ValueError as e:
+        parser.error(str(e))
+
+    table = significance_table(data, cli_args.by)
+
+    table.to_csv(cli_args.output, index=False)
+    print(f'Saved {len(table)} comparisons to {cli_args.output}')
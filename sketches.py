@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+
+
+# Mergeable summary of a set of values: count, mean and the 2nd/3rd central moment sums
+# (M2, M3), min/max and a t-digest of (means, weights) centroids for the quantiles.
+# While a summary holds fewer than CAPACITY values every centroid is a single value,
+# so its quantiles are exact. Past that, centroids are merged, keeping the tails precise.
+Summary = namedtuple('Summary', ['count', 'mean', 'm2', 'm3', 'min', 'max', 'means', 'weights'])
+
+CAPACITY = 1000
+
+def summarize(values, capacity=CAPACITY):
+    values = np.sort(np.asarray(values, dtype=float))
+    values = values[~np.isnan(values)]
+
+    count = len(values)
+    if count == 0:
+        return Summary(0, np.nan, 0.0, 0.0, np.nan, np.nan, values, np.ones(0))
+
+    mean = values.mean()
+    deviation = values - mean
+
+    return compress(Summary(count, mean, (deviation ** 2).sum(), (deviation ** 3).sum(), values[0], values[-1], values, np.ones(count)), capacity)
+
+def compress(summary, capacity=CAPACITY):
+    if len(summary.means) <= capacity:
+        return summary
+
+    # t-digest k1 scale function: clusters are small near the tails and large around the median
+    weights = summary.weights
+    q = (np.cumsum(weights) - weights / 2) / summary.count
+    cluster = np.floor(capacity / (2 * np.pi) * np.arcsin(2 * q - 1)).astype(int)
+    cluster -= cluster[0]
+
+    cluster_weights = np.bincount(cluster, weights=weights)
+    cluster_means = np.bincount(cluster, weights=summary.means * weights)
+    keep = cluster_weights > 0
+
+    return summary._replace(means=cluster_means[keep] / cluster_weights[keep], weights=cluster_weights[keep])
+
+def merge(summaries, capacity=CAPACITY):
+    summaries = [summary for summary in summaries if summary.count]
+    if not summaries:
+        return summarize([])
+    if len(summaries) == 1:
+        return summaries[0]
+
+    counts = np.array([summary.count for summary in summaries], dtype=float)
+    means = np.array([summary.mean for summary in summaries])
+    m2s = np.array([summary.m2 for summary in summaries])
+    m3s = np.array([summary.m3 for summary in summaries])
+
+    # Combine the moments around the overall mean
+    count = counts.sum()
+    mean = (counts * means).sum() / count
+    deviation = means - mean
+    m2 = (m2s + counts * deviation ** 2).sum()
+    m3 = (m3s + 3 * deviation * m2s + counts * deviation ** 3).sum()
+
+    centroid_means = np.concatenate([summary.means for summary in summaries])
+    centroid_weights = np.concatenate([summary.weights for summary in summaries])
+    order = np.argsort(centroid_means, kind='stable')
+
+    merged = Summary(int(count), mean, m2, m3, min(summary.min for summary in summaries), max(summary.max for summary in summaries), centroid_means[order], centroid_weights[order])
+    return compress(merged, capacity)
+
+def quantile(summary, q):
+    # Linear interpolation between the centroids, which for single-value centroids is the
+    # same as pandas/numpy's default quantile
+    if summary.count == 0:
+        return np.nan
+
+    positions = np.cumsum(summary.weights) - summary.weights / 2
+    means = summary.means
+
+    # Anchor the tails on the exact min and max
+    if summary.weights[0] > 1:
+        positions, means = np.r_[0.5, positions], np.r_[summary.min, means]
+    if summary.weights[-1] > 1:
+        positions, means = np.r_[positions, summary.count - 0.5], np.r_[means, summary.max]
+
+    return float(np.interp(q * (summary.count - 1) + 0.5, positions, means))
+
+def statistics(summary, k=1.5):
+    # The same measures and outlier gates as process_results.group_statistics, for one summary
+    count = summary.count
+    variance = summary.m2 / (count - 1) if count > 1 else np.nan
+
+    skewness = np.nan
+    if count > 2:
+        skewness = 0.0 if summary.m2 == 0 else np.sqrt(count * (count - 1)) / (count - 2) * (summary.m3 / count) / (summary.m2 / count) ** 1.5
+
+    q1 = quantile(summary, 0.25)
+    q3 = quantile(summary, 0.75)
+
+    return {
+        'mean': summary.mean,
+        'std': np.sqrt(variance),
+        'median': quantile(summary, 0.5),
+        'var': variance,
+        'skew': skewness,
+        'min': summary.min,
+        'max': summary.max,
+        'size': count,
+        'Q1': q1,
+        'Q3': q3,
+        'Lower gate': q1 - k * (q3 - q1),
+        'Upper gate': q3 + k * (q3 - q1)
+    }
+
+def summarize_groups(data, column='Retrieval Time (ms)', capacity=CAPACITY):
+    # {group: Summary} for grouped data, sorting all the values once
+    codes = data.ngroup().to_numpy()
+    values = data.obj[column].to_numpy(dtype=float)
+
+    keep = (codes >= 0) & ~np.isnan(values)
+    order = np.lexsort((values[keep], codes[keep]))
+    codes, values = codes[keep][order], values[keep][order]
+
+    bounds = np.searchsorted(codes, np.arange(data.ngroups + 1))
+    return {name: summarize(values[bounds[code]:bounds[code + 1]], capacity) for code, name in enumerate(data.size().index)}
+
+def statistics_frame(summaries, k=1.5):
+    # Same layout as process_results.group_statistics: one row per group, in group order
+    groups = sorted(summaries)
+    return pd.DataFrame([statistics(summaries[group], k) for group in groups], index=pd.Index(groups, name='Size (Bytes)'))
+
+def merge_groups(summaries_list, capacity=CAPACITY):
+    # Merge a list of {group: Summary} group by group
+    groups = sorted(set().union(*summaries_list)) if summaries_list else []
+    return {group: merge([summaries[group] for summaries in summaries_list if group in summaries], capacity) for group in groups}
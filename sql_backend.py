@@ -0,0 +1,455 @@
+import os
+import sqlite3
+import logging
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+import process_results as results
+import process_folders
+import records_index
+import manifest
+
+# Alternative engine computing the statistics functions in SQL. Every indexed CSV is loaded once
+# into a single records table (partitioned by file, with the campaign/backend/experiment/host of its
+# path as columns of the files table) and the functions run as grouped queries over all the files
+# at once, split into one query per experiment that run in parallel threads. The queries group the
+# rows by a key: the file for process_results, the experiment, the site or the whole root for the
+# scopes of process_folders.
+DATABASE_FILE = os.path.join(results.CACHE_DIR or '.records_cache', 'records.sqlite')
+
+# Threads running queries at once, each with its own connection
+WORKERS = int(os.environ.get('SQL_WORKERS', os.cpu_count() or 1))
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = {
+    'Retrieval Time (ms)': 'time',
+    'Size in Repo(Bytes)': 'repo_size',
+    'Size (Bytes)': 'size'
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    campaign TEXT,
+    backend TEXT,
+    operation TEXT,
+    experiment TEXT,
+    host TEXT,
+    site TEXT,
+    modified INTEGER
+);
+CREATE TABLE IF NOT EXISTS records (
+    file_id INTEGER,
+    row INTEGER,
+    date TEXT,
+    time REAL,
+    repo_size INTEGER,
+    type TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS records_by_file ON records (file_id, size);
+CREATE VIEW IF NOT EXISTS records_view AS
+    SELECT files.path, files.campaign, files.backend, files.operation, files.experiment, files.host, files.site, records.*
+    FROM records JOIN files USING (file_id);
+"""
+
+QUANTILES = {'Q1': 0.25, 'median': 0.5, 'Q3': 0.75}
+
+def connect(database_file=DATABASE_FILE):
+    os.makedirs(os.path.dirname(database_file) or '.', exist_ok=True)
+    connection = sqlite3.connect(database_file)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+def file_rows(file_id, data):
+    # The rows of a parsed CSV in the layout of the records table, with NAs as NULL
+    rows = pd.DataFrame({
+        'file_id': file_id,
+        'row': data.index,
+        'date': data['Date'].dt.strftime(results.DATE_FORMAT) if 'Date' in data else None,
+        'time': data['Retrieval Time (ms)'],
+        'repo_size': data['Size in Repo(Bytes)'] if 'Size in Repo(Bytes)' in data else None,
+        'type': data['Type'].astype(object) if 'Type' in data else None,
+        'size': data['Size (Bytes)']
+    })
+
+    return rows.astype(object).where(rows.notna(), None).itertuples(index=False, name=None)
+
+def update_database(index, database_file=DATABASE_FILE):
+    # Load the files of the index that are new or have changed since they were loaded
+    connection = connect(database_file)
+
+    with connection:
+        known = dict(connection.execute('SELECT path, modified FROM files'))
+
+        for entry in index.to_dict('records'):
+            if known.pop(entry['Path'], None) == entry['Modified']:
+                continue
+
+            logger.info('Loading into the database: %s', entry['Path'])
+            connection.execute('DELETE FROM records WHERE file_id IN (SELECT file_id FROM files WHERE path = ?)', (entry['Path'],))
+            connection.execute('DELETE FROM files WHERE path = ?', (entry['Path'],))
+
+            file_id = connection.execute(
+                'INSERT INTO files (path, campaign, backend, operation, experiment, host, site, modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [entry[column] for column in ['Path', 'Campaign', 'Backend', 'Operation', 'Experiment', 'Host', 'Site', 'Modified']]
+            ).lastrowid
+            connection.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?)', file_rows(file_id, results.read_records(entry['Path'])))
+
+        # Whatever is left in known has been deleted
+        for path in known:
+            connection.execute('DELETE FROM records WHERE file_id IN (SELECT file_id FROM files WHERE path = ?)', (path,))
+            connection.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    connection.close()
+
+def selected_rows(key, column, paths):
+    # CTE of the non NA rows of the given files, like read_columns(dropna=True), in the group of their key
+    return f"""selected AS (
+        SELECT {key} AS scope, row, {COLUMNS[column]} AS value, size FROM records_view
+        WHERE path IN ({', '.join('?' * len(paths))}) AND {COLUMNS[column]} IS NOT NULL AND size IS NOT NULL
+    )"""
+
+def statistics_query(key, column, paths, k=1.5):
+    # CTEs of the statistics and outlier gates of every (key, size) group, as in results.group_statistics.
+    # The quantiles interpolate linearly between the two closest ranks, like pandas.
+    groups = 'scope, size'
+    quantiles = ',\n'.join(
+        f"""SUM(CASE WHEN position = CAST((n - 1) * {q} AS INTEGER) THEN value END) AS "{name} low",
+        SUM(CASE WHEN position = CAST((n - 1) * {q} AS INTEGER) + 1 THEN value END) AS "{name} high",
+        (n - 1) * {q} - CAST((n - 1) * {q} AS INTEGER) AS "{name} fraction\""""
+        for name, q in QUANTILES.items()
+    )
+    interpolated = ',\n'.join(
+        f'"{name} low" + (COALESCE("{name} high", "{name} low") - "{name} low") * "{name} fraction" AS "{name}"'
+        for name in QUANTILES
+    )
+
+    return f"""WITH {selected_rows(key, column, paths)},
+    ranked AS (
+        SELECT *, ROW_NUMBER() OVER sorted - 1 AS position, COUNT(*) OVER grouped AS n, AVG(value) OVER grouped AS mean
+        FROM selected
+        WINDOW grouped AS (PARTITION BY {groups}), sorted AS (grouped ORDER BY value)
+    ),
+    moments AS (
+        SELECT {groups}, n, mean,
+            SUM((value - mean) * (value - mean)) AS m2,
+            SUM((value - mean) * (value - mean) * (value - mean)) AS m3,
+            MIN(value) AS min, MAX(value) AS max,
+            {quantiles}
+        FROM ranked GROUP BY {groups}
+    ),
+    statistics AS (
+        SELECT {groups}, n, mean, m2, m3, min, max, {interpolated}
+        FROM moments
+    ),
+    gates AS (
+        SELECT {groups}, Q1 - {k} * (Q3 - Q1) AS "Lower gate", Q3 + {k} * (Q3 - Q1) AS "Upper gate"
+        FROM statistics
+    )"""
+
+def finish_statistics(frame):
+    # Variance, standard deviation and skewness from the moments, named as in results.group_statistics
+    n = frame['n'].astype(float)
+    m2, m3 = frame.pop('m2'), frame.pop('m3')
+
+    frame['var'] = (m2 / (n - 1)).where(n > 1)
+    frame['std'] = np.sqrt(frame['var'])
+    frame['skew'] = (np.sqrt(n * (n - 1)) / (n - 2) * (m3 / n) / (m2 / n) ** 1.5).where(n > 2)
+    frame.loc[(n > 2) & (m2 == 0), 'skew'] = 0.0
+
+    return frame.rename(columns={'n': 'size', 'size': 'Size (Bytes)'})
+
+def measures_frame(stats):
+    # Same layout as results.find_measures
+    df = stats[list(results.MEASURES_COLUMNS)].rename(columns=results.MEASURES_COLUMNS).reset_index(drop=True)
+    df.insert(0, 'Group', [results.bytes_to_size(name) for name in stats['Size (Bytes)']])
+
+    return df
+
+local = threading.local()
+
+def read_query(database_file, sql, params):
+    # Connections can't be shared between threads, every thread opens its own
+    connections = local.__dict__.setdefault('connections', {})
+    if database_file not in connections:
+        connections[database_file] = sqlite3.connect(database_file)
+
+    return pd.read_sql_query(sql, connections[database_file], params=params)
+
+def split_scopes(frame):
+    # {key: rows} of a query result ordered by key
+    return {scope: rows.drop(columns='scope').reset_index(drop=True) for scope, rows in frame.groupby('scope', sort=False)}
+
+def find_measures(paths, column, database_file, key='path'):
+    frame = read_query(database_file, f'{statistics_query(key, column, paths)} SELECT * FROM statistics ORDER BY scope, size', paths)
+    frame = finish_statistics(frame)
+
+    return {scope: measures_frame(stats) for scope, stats in frame.groupby('scope', sort=False)}
+
+def find_outliers(paths, column, database_file, key='path'):
+    # Rows outside their group's gates, ordered group by group, as in results.find_outliers
+    frame = read_query(database_file, f"""{statistics_query(key, column, paths)}
+        SELECT scope, row AS "index", value AS "{column}", size AS "Size (Bytes)"
+        FROM selected JOIN gates USING (scope, size)
+        WHERE value < "Lower gate" OR value > "Upper gate"
+        ORDER BY scope, size, row""", paths)
+
+    return split_scopes(frame)
+
+def group_results(paths, column, database_file, key='path'):
+    frame = read_query(database_file, f"""WITH {selected_rows(key, column, paths)}
+        SELECT scope, row AS "index", value AS "{column}", size AS "Size (Bytes)"
+        FROM selected ORDER BY scope, size, row""", paths)
+
+    return split_scopes(frame)
+
+def na_ratio(paths, column, database_file, key='path'):
+    # Over every row, NAs included, as in process_folders.na_ratio
+    frame = read_query(database_file, f"""
+        SELECT {key} AS scope, COUNT(*) AS Total, COUNT(*) - COUNT({COLUMNS[column]}) AS NAs
+        FROM records_view WHERE path IN ({', '.join('?' * len(paths))})
+        GROUP BY scope ORDER BY scope""", paths)
+    frame['NA Ratio (%)'] = frame['NAs'] / frame['Total'] * 100
+
+    return split_scopes(frame)
+
+# SQL equivalents of the functions of the functions lists, by name
+SQL_FUNCTIONS = {
+    'find_measures': find_measures,
+    'find_outliers': find_outliers,
+    'group_results': group_results,
+    'na_ratio': na_ratio
+}
+
+# The key and the index columns partitioning the queries of every scope of process_folders. A root
+# is one campaign, backend and operation, so a constant key groups all its files in one scope.
+SCOPE_KEYS = {
+    'experiments': ('experiment', 'Experiment'),
+    'all': ("'all'", None),
+    'clients': ('site', 'Site')
+}
+
+# The outputs of find_outliers and group_results over a scope carry every column of its records, the
+# SQL engine only computes them per file
+SCOPE_FUNCTIONS = ['find_measures', 'na_ratio']
+
+def supports(func_info, scope=False):
+    # Entries computing one of the functions above straight from the grouped records
+    return (func_info['function'].__name__ in (SCOPE_FUNCTIONS if scope else SQL_FUNCTIONS)
+            and getattr(func_info.get('data_load_function'), '__name__', None) in [None, 'read_columns_and_groupby', 'groupby']
+            and not func_info.get('args')
+            and 'data_process_function' not in func_info
+            and not func_info.get('function_kwargs')
+            and not func_info.get('shared_kwargs'))
+
+def run_function(name, files, column='Retrieval Time (ms)', database_file=DATABASE_FILE, workers=None, key='path', partition=['Campaign', 'Backend', 'Experiment']):
+    # {key: result} of the function for every file (or scope), with one query per partition running in parallel
+    if workers is None:
+        workers = WORKERS
+
+    partitions = [list(files['Path'])] if partition is None else [list(rows['Path']) for _, rows in files.groupby(partition)]
+    function = SQL_FUNCTIONS[name]
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        frames = {}
+        for partition_frames in pool.map(lambda paths: function(paths, column, database_file, key), partitions):
+            frames.update(partition_frames)
+
+    return frames
+
+def select_root(index, root_dir):
+    root = os.path.normpath(root_dir) + os.sep
+    return index[index['Path'].str.startswith(root)]
+
+def process_csv_files(root_dir, column, functions, incremental=False, database_file=DATABASE_FILE):
+    # Same outputs as results.process_csv_files for the entries the SQL engine supports,
+    # returns the entries that still have to go through the pandas engine
+    sql_functions = [func_info for func_info in functions if supports(func_info)]
+
+    index = records_index.update_index()
+    update_database(index, database_file)
+    files = select_root(index, root_dir)
+
+    processed_dir = os.path.normpath(root_dir) + '_processed_by_experiment_and_client'
+    if incremental:
+        outputs_manifest = manifest.load_manifest(processed_dir)
+
+    for func_info in sql_functions:
+        spec = manifest.spec_signature(func_info)
+        pending = []
+
+        for entry in files.to_dict('records'):
+            output_dir = os.path.join(processed_dir, entry['Experiment'], func_info['output_dir'])
+            name, _ = os.path.splitext(os.path.basename(entry['Path']))
+            key = manifest.output_key(processed_dir, output_dir, name)
+            inputs = manifest.inputs_signature({entry['Path']: results.file_fingerprint(entry['Path'])})
+
+            if incremental and manifest.is_up_to_date(outputs_manifest, processed_dir, key, inputs, spec):
+                logger.info('\tUp to date: %s', key)
+                continue
+
+            pending.append((entry, output_dir, name, key, inputs))
+
+        if not pending:
+            continue
+
+        logger.info('Computing %s in SQL for %d files of %s', func_info['function'].__name__, len(pending), root_dir)
+        frames = run_function(func_info['function'].__name__, files[files['Path'].isin([entry['Path'] for entry, *_ in pending])], column, database_file)
+
+        for entry, output_dir, name, key, inputs in pending:
+            outputs = func_info['output_function'](frames.get(entry['Path'], pd.DataFrame()), output_dir, name)
+
+            if incremental:
+                manifest.record(outputs_manifest, processed_dir, key, inputs, spec, outputs)
+
+        if incremental:
+            manifest.save_manifest(outputs_manifest, processed_dir)
+
+    return [func_info for func_info in functions if not supports(func_info)]
+
+def process_scopes(root_dir, column, functions, scopes, incremental=False, database_file=DATABASE_FILE):
+    # Same outputs as the given scopes of process_folders.process_root for the entries the SQL engine
+    # supports over a scope, returns the entries that still have to go through the pandas engine.
+    # The database has to be up to date, see update_database.
+    sql_functions = [func_info for func_info in functions if supports(func_info, scope=True)]
+
+    files = select_root(records_index.load_index(), root_dir)
+    # The paths the walk of process_folders.ingest finds, which the manifests are keyed by
+    walk_paths = {path: os.path.join(root_dir, os.path.relpath(path, root_dir)) for path in files['Path']}
+
+    for scope in scopes:
+        key, partition = SCOPE_KEYS[scope]
+        output_dir_root = process_folders.processed_dir(root_dir, process_folders.SCOPE_SUFFIXES[scope])
+        if incremental:
+            outputs_manifest = manifest.load_manifest(output_dir_root)
+
+        scope_files = {'all': list(files['Path'])} if partition is None else {name: list(rows['Path']) for name, rows in files.groupby(partition)}
+
+        for func_info in sql_functions:
+            spec = manifest.spec_signature(func_info)
+            pending = []
+
+            for name, paths in scope_files.items():
+                output_dir = os.path.join(output_dir_root, func_info['output_dir'])
+                key_name = manifest.output_key(output_dir_root, output_dir, name)
+                inputs = manifest.inputs_signature({walk_paths[path]: results.file_fingerprint(path) for path in paths})
+
+                if incremental and manifest.is_up_to_date(outputs_manifest, output_dir_root, key_name, inputs, spec):
+                    logger.info('\tUp to date: %s', key_name)
+                    continue
+
+                pending.append((name, output_dir, key_name, inputs))
+
+            if not pending:
+                continue
+
+            logger.info('Computing %s in SQL for %d scopes (%s) of %s', func_info['function'].__name__, len(pending), scope, root_dir)
+            frames = run_function(func_info['function'].__name__, files, column, database_file, key=key, partition=partition)
+
+            for name, output_dir, key_name, inputs in pending:
+                outputs = func_info['output_function'](frames.get(name, pd.DataFrame()), output_dir, name)
+
+                if incremental:
+                    manifest.record(outputs_manifest, output_dir_root, key_name, inputs, spec, outputs)
+
+        if incremental:
+            manifest.save_manifest(outputs_manifest, output_dir_root)
+
+    return [func_info for func_info in functions if not supports(func_info, scope=True)]
+
+def pandas_result(name, path, column='Retrieval Time (ms)'):
+    if name == 'na_ratio':
+        return process_folders.na_ratio(results.read_all(path, dropna=False), column)
+    if name == 'group_results':
+        return results.group_results(results.read_columns_and_groupby(path, columns=[column, 'Size (Bytes)']))
+
+    return getattr(results, name)(results.read_columns_and_groupby(path, columns=[column, 'Size (Bytes)']), column)
+
+def check(files, column='Retrieval Time (ms)', database_file=DATABASE_FILE, rtol=1e-9):
+    # Compare the results of the SQL engine with the pandas functions for every file,
+    # returns the (function, path, difference) that don't match
+    mismatches = []
+
+    for name in SQL_FUNCTIONS:
+        frames = run_function(name, files, column, database_file)
+
+        for path in files['Path']:
+            expected = pandas_result(name, path, column).reset_index(drop=True)
+            try:
+                pd.testing.assert_frame_equal(frames.get(path, expected.iloc[:0]), expected, check_dtype=False, check_index_type=False, rtol=rtol)
+            except AssertionError as e:
+                mismatches.append((name, path, str(e)))
+
+    return mismatches
+
+# The process_folders.select tag of every scope
+SCOPE_TAGS = {'experiments': 'experiment', 'all': None, 'clients': 'client'}
+
+def pandas_scope_result(name, data, column='Retrieval Time (ms)'):
+    if name == 'na_ratio':
+        return process_folders.na_ratio(data, column)
+
+    return getattr(results, name)(process_folders.groupby(data.dropna()), column)
+
+def check_scopes(files, column='Retrieval Time (ms)', database_file=DATABASE_FILE, rtol=1e-9):
+    # Compare the results of the SQL engine over the scopes of process_folders with the pandas functions,
+    # both over the given files of every root. Returns the (function, scope, difference) that don't match
+    # and the number of results compared.
+    mismatches = []
+    compared = 0
+
+    for (campaign, backend, operation), root_files in files.groupby(['Campaign', 'Backend', 'Operation']):
+        root_dir = os.path.join(records_index.RECORDS_DIR, campaign, backend, operation)
+        records = process_folders.ingest(root_dir)
+        records = records[records['File'].isin([os.path.join(root_dir, os.path.relpath(path, root_dir)) for path in root_files['Path']])]
+
+        for scope, (key, partition) in SCOPE_KEYS.items():
+            names = ['all'] if partition is None else sorted(root_files[partition].unique())
+
+            for name in SCOPE_FUNCTIONS:
+                frames = run_function(name, root_files, column, database_file, key=key, partition=partition)
+
+                for scope_name in names:
+                    tags = {} if SCOPE_TAGS[scope] is None else {SCOPE_TAGS[scope]: scope_name}
+                    expected = pandas_scope_result(name, process_folders.select(records, **tags), column).reset_index(drop=True)
+                    try:
+                        pd.testing.assert_frame_equal(frames.get(scope_name, expected.iloc[:0]), expected, check_dtype=False, check_index_type=False, rtol=rtol)
+                    except AssertionError as e:
+                        mismatches.append((name, f'{root_dir} ({scope}) {scope_name}', str(e)))
+                    compared += 1
+
+    return mismatches, compared
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load the CSV records into the SQL database and check the SQL engine against the pandas functions')
+    parser.add_argument('--database', default=DATABASE_FILE)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='threads running queries at once')
+    for tag in ['campaign', 'backend', 'operation', 'experiment', 'host', 'site']:
+        parser.add_argument(f'--{tag}', action='append')
+    cli_args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(message)s')
+    WORKERS = cli_args.workers
+
+    index = records_index.update_index()
+    update_database(index, cli_args.database)
+
+    criteria = {tag: values for tag, values in vars(cli_args).items() if values and tag not in ['database', 'workers']}
+    files = records_index.select_files(index, **criteria)
+
+    mismatches = check(files, database_file=cli_args.database)
+    for name, path, difference in mismatches:
+        print(f'{name} {path}: {difference}')
+    print(f'{len(SQL_FUNCTIONS) * len(files) - len(mismatches)} of {len(SQL_FUNCTIONS) * len(files)} results match the pandas engine')
+
+    mismatches, compared = check_scopes(files, database_file=cli_args.database)
+    for name, scope, difference in mismatches:
+        print(f'{name} {scope}: {difference}')
+    print(f'{compared - len(mismatches)} of {compared} scope results match the pandas engine')
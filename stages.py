@@ -0,0 +1,103 @@
+import os
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import instrument
+
+# The entries of a `functions` list are compiled into a tree of stages. Every stage applies
+# function(data, *args, **kwargs) to the output of its parent, and entries that start with the same
+# stages (same load, dropna, groupby, outlier split...) share them, so they are computed once.
+
+# Number of threads running independent stages at once
+WORKERS = int(os.environ.get('STAGE_WORKERS', 1))
+
+def drop_na(data):
+    return data.dropna()
+
+def function_chain(func_info, dropna=False):
+    chain = []
+
+    if dropna and func_info.get('dropna', True):
+        chain.append((drop_na, [], {}))
+
+    if 'data_load_function' in func_info:
+        chain.append((func_info['data_load_function'], func_info.get('args', []), {}))
+
+    if 'data_process_function' in func_info:
+        chain.append((func_info['data_process_function'], [], {}))
+
+    function = func_info['function']
+    if hasattr(function, 'shared_stage'):
+        # Keyword arguments of the shared stage, e.g. {'method': 'mad:z=3.5'} for split_outliers
+        chain.append((function.shared_stage, [], func_info.get('shared_kwargs', {})))
+
+    # Optional keyword arguments of the function itself, e.g. {'bootstrap': 1000} for find_measures
+    chain.append((function, [], func_info.get('function_kwargs', {})))
+    return chain
+
+def compile_stages(functions, dropna=False):
+    stages = {}
+    children = {(): []}
+    entries = {}
+
+    for index, func_info in enumerate(functions):
+        key = ()
+        for function, args, kwargs in function_chain(func_info, dropna):
+            stage = key + ((function, repr(args), repr(kwargs)),)
+
+            if stage not in stages:
+                stages[stage] = (function, args, kwargs)
+                children[key].append(stage)
+                children[stage] = []
+            key = stage
+
+        entries.setdefault(key, []).append(index)
+
+    return {'stages': stages, 'children': children, 'entries': entries}
+
+def stage_input(dag, parent, value):
+    # Stages may modify their input in place (e.g. groupby converting the column type),
+    # so a DataFrame that is the caller's data or feeds several stages is copied
+    if isinstance(value, pd.DataFrame) and (parent == () or len(dag['children'][parent]) > 1):
+        return value.copy()
+
+    return value
+
+def run_stages(dag, data, on_result, workers=None):
+    # Run every stage of the dag on data and call on_result(index, result) for each
+    # entry of the functions list as soon as it is computed. on_result always runs in
+    # the calling thread, while with workers > 1 independent stages run concurrently.
+    stages, children, entries = dag['stages'], dag['children'], dag['entries']
+    if workers is None:
+        workers = WORKERS
+
+    def finish(stage, value):
+        for index in entries.get(stage, []):
+            on_result(index, value)
+
+        # The children get their inputs now, after that the result is no longer needed
+        return [(child, stage_input(dag, stage, value)) for child in children[stage]]
+
+    if workers <= 1:
+        # Depth first, so results come in the order of the functions list
+        pending = list(reversed([(stage, stage_input(dag, (), data)) for stage in children[()]]))
+        while pending:
+            stage, value = pending.pop()
+            function, args, kwargs = stages[stage]
+            pending += reversed(finish(stage, instrument.call(function.__name__, 'stage', function, value, *args, **kwargs)))
+        return
+
+    with ThreadPoolExecutor(workers) as pool:
+        running = {}
+
+        def submit(ready):
+            for stage, value in ready:
+                function, args, kwargs = stages[stage]
+                running[pool.submit(instrument.call, function.__name__, 'stage', function, value, *args, **kwargs)] = stage
+
+        submit([(stage, stage_input(dag, (), data)) for stage in children[()]])
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                submit(finish(stage, future.result()))
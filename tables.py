@@ -0,0 +1,118 @@
+import os
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+
+import process_results as results
+import records_index
+
+logger = logging.getLogger(__name__)
+
+# booktabs tables (host x data size) of every experiment, one tables.tex per campaign
+TABLES_FILE = 'tables.tex'
+
+STATS = ['mean', 'median']
+
+def latex_escape(text):
+    for char in ['&', '%', '$', '#', '_', '{', '}']:
+        text = text.replace(char, '\\' + char)
+
+    return text
+
+def experiment_table(files, stat='mean', clean=False, column='Retrieval Time (ms)'):
+    # The statistic of every host and size over the host's sample: the first N values of every
+    # size, N being the sample size of the host, i.e. its smallest group
+    values = {}
+    sample_sizes = {}
+    for host, host_files in files.groupby('Host', sort=True):
+        data = pd.concat([results.read_columns(path, columns=[column, 'Size (Bytes)']) for path in host_files['Path']], ignore_index=True)
+        data['Size (Bytes)'] = data['Size (Bytes)'].astype(int)
+
+        sample_sizes[host] = data.groupby('Size (Bytes)').size().min() if len(data) else 0
+        grouped = data.groupby('Size (Bytes)').head(sample_sizes[host]).groupby('Size (Bytes)')
+        if clean:
+            grouped = results.remove_outliers(grouped, column).groupby('Size (Bytes)')
+
+        values[host] = grouped[column].agg(stat)
+
+    table = pd.DataFrame(values).T
+    table = table[sorted(table.columns)]
+
+    return table, pd.Series(sample_sizes)
+
+def latex_table(table, sample_sizes, caption, sample_size=True):
+    sizes = [str(size) for size in table.columns]
+    columns = len(sizes) + (1 if sample_size else 0)
+
+    lines = [
+        '% Please add the following required packages to your document preamble:',
+        '% \\usepackage{booktabs}',
+        '\\begin{table}',
+        f'\\caption{{{latex_escape(caption)}}}',
+        f'\\begin{{tabular}}{{@{{}}l{"c" * columns}@{{}}}}',
+        '\\toprule',
+        f'Host    & \\multicolumn{{{len(sizes)}}}{{c}}{{Data Size}}          ' + ('& Sample Size ' if sample_size else '') + '\\\\ \\midrule',
+        '& ' + '  & '.join(sizes) + '              \\\\ \\midrule'
+    ]
+
+    for host, row in table.iterrows():
+        cells = ['-' if np.isnan(value) else f'{value:.0f}' for value in row]
+        if sample_size:
+            cells.append(str(sample_sizes[host]))
+        lines.append(f'{latex_escape(host)}  & ' + '  & '.join(cells) + ' \\\\')
+
+    lines += [
+        '\\bottomrule',
+        '\\end{tabular}',
+        '\\end{table}'
+    ]
+    return '\n'.join(lines)
+
+def generate_tables(stat='mean', clean=False, sample_size=True, records_dir=records_index.RECORDS_DIR, **criteria):
+    # Regenerate the tables.tex of every campaign from the (cached) records
+    index = records_index.select_files(records_index.update_index(), **criteria)
+
+    # The tables of a campaign are kept in its first directory, e.g. miletus_degroot_nancy for miletus_degroot_nancy/19-06-2023
+    roots = index['Campaign'].str.split('/').str[0]
+    tables_files = []
+
+    for root, campaign_files in index.groupby(roots, sort=True):
+        several_backends = campaign_files['Backend'].nunique() > 1
+        tables = []
+
+        for (backend, experiment), files in campaign_files.groupby(['Backend', 'Experiment'], sort=True):
+            caption = f'Table for experiment {experiment}'
+            if several_backends:
+                caption += f' ({backend})'
+            if stat != 'mean' or clean:
+                caption += f', {stat}' + (' without outliers' if clean else '')
+
+            table, sample_sizes = experiment_table(files, stat, clean)
+            tables.append(latex_table(table, sample_sizes, caption, sample_size))
+
+        tables_file = os.path.join(records_dir, root, TABLES_FILE)
+        with open(tables_file, 'w') as f:
+            f.write(f'All tables under: {os.path.join("csv_records", os.path.normpath(tables_file))}\n')
+            f.write('\n\n'.join(tables) + '\n')
+
+        logger.info('Saved tables to %s', tables_file)
+        tables_files.append(tables_file)
+
+    return tables_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the LaTeX tables of every experiment from the CSV records')
+    parser.add_argument('--stat', default='mean', choices=STATS)
+    parser.add_argument('--clean', action='store_true', help='use the values left after removing the outliers of the sample of every host and size')
+    parser.add_argument('--no-sample-size', action='store_true', help='leave out the sample size column')
+    parser.add_argument('--operation', default='retrieve')
+    for tag in ['campaign', 'backend', 'experiment']:
+        parser.add_argument(f'--{tag}', action='append')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level, format='%(message)s')
+
+    criteria = {tag: values for tag, values in vars(cli_args).items() if values and tag in ['campaign', 'backend', 'experiment', 'operation']}
+    generate_tables(cli_args.stat, cli_args.clean, not cli_args.no_sample_size, **criteria)
@@ -0,0 +1,289 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+import argparse
+import traceback
+
+import process_results as results
+import process_folders as folders
+import records_index
+import output_store
+import tables
+
+logger = logging.getLogger(__name__)
+
+# Watch mode: one long-running process keeps the libraries, the render processes and the parsed
+# records warm, waits for CSVs to be added, changed or removed under the records directory and
+# recomputes only what depends on them: the per-file outputs of the changed files, the root,
+# experiment and client scopes of process_folders that contain them, and the tables. Everything
+# else is left to the manifests, so an update writes exactly what an incremental run of the scripts
+# would, removing the outputs of the files and scopes that no longer have any records.
+# Changes are detected with inotify, or by polling the files where inotify isn't available, and
+# a burst of them is handled as one update once no new change has come for DEBOUNCE seconds.
+DEBOUNCE = 2.0
+MAX_DELAY = 30.0
+POLL_INTERVAL = 5.0
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event: wd, mask, cookie, len, then the name padded to len bytes
+EVENT_HEADER = struct.Struct('iIII')
+
+def watched_dirs(directory):
+    # Every directory of the records, not the trees produced by process_folders/process_results
+    for dirName, subdirList, _ in os.walk(directory):
+        subdirList[:] = sorted(subdir for subdir in subdirList if '_processed' not in subdir)
+        yield dirName
+
+def open_inotify(records_dir):
+    # {'fd', 'libc', 'records_dir', 'watches': {wd: directory}}, None where inotify isn't available
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    inotify = {'fd': fd, 'libc': libc, 'records_dir': records_dir, 'watches': {}}
+    try:
+        add_watches(inotify, records_dir)
+    except OSError as e:
+        # Usually ENOSPC, more directories than fs.inotify.max_user_watches
+        logger.warning('Can not watch %s: %s', records_dir, e)
+        os.close(fd)
+        return None
+
+    return inotify
+
+def add_watches(inotify, directory):
+    for dirName in watched_dirs(directory):
+        wd = inotify['libc'].inotify_add_watch(inotify['fd'], os.fsencode(dirName), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), dirName)
+
+        inotify['watches'][wd] = dirName
+
+def read_inotify(inotify, timeout=None):
+    # Paths changed within timeout seconds (None waits for the first one): CSVs, and directories
+    # moved out of the records, whose files aren't reported one by one
+    changed = set()
+    ready, _, _ = select.select([inotify['fd']], [], [], timeout)
+    if not ready:
+        return changed
+
+    try:
+        buffer = os.read(inotify['fd'], 64 * 1024)
+    except BlockingIOError:
+        return changed
+
+    offset = 0
+    while offset < len(buffer):
+        wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+        name = os.fsdecode(buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+        offset += EVENT_HEADER.size + length
+
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, so every file may have changed. The manifests skip those that haven't.
+            changed.update(records_index.find_record_files(inotify['records_dir']))
+            continue
+
+        if mask & IN_IGNORED:
+            inotify['watches'].pop(wd, None)
+            continue
+
+        directory = inotify['watches'].get(wd)
+        if directory is None:
+            continue
+
+        path = os.path.join(directory, name)
+        if not mask & IN_ISDIR:
+            if name.endswith('.csv'):
+                changed.add(path)
+        elif '_processed' not in name:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may have landed in it before its watch was added
+                add_watches(inotify, path)
+                changed.update(records_index.find_record_files(path))
+            elif mask & IN_MOVED_FROM:
+                changed.add(path)
+
+    return changed
+
+def snapshot(records_dir):
+    # {path: [size, mtime]} of every CSV of the records
+    files = {}
+    for file_path in records_index.find_record_files(records_dir):
+        try:
+            files[file_path] = results.file_fingerprint(file_path)[1:]
+        except OSError:
+            # Removed since it was listed
+            continue
+
+    return files
+
+def polling_source(records_dir, interval=POLL_INTERVAL):
+    # A source of changes, like read_inotify, comparing snapshots of the files every interval seconds
+    state = {'snapshot': snapshot(records_dir)}
+
+    def source(timeout=None):
+        time.sleep(interval if timeout is None else min(interval, timeout))
+
+        current = snapshot(records_dir)
+        previous = state['snapshot']
+        state['snapshot'] = current
+
+        return {path for path in previous.keys() | current.keys() if previous.get(path) != current.get(path)}
+
+    return source
+
+def wait_for_changes(source, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+    # Block until something changes, then keep collecting the changes until none has come for
+    # debounce seconds, or for at most max_delay seconds while files keep arriving
+    changed = set()
+    while not changed:
+        changed = source(None)
+
+    deadline = time.monotonic() + max_delay
+    while time.monotonic() < deadline:
+        more = source(min(debounce, max(0, deadline - time.monotonic())))
+        if not more:
+            break
+        changed |= more
+
+    return changed
+
+def affected_roots(paths, root_dirs):
+    # {root_dir: changed paths under it}, paths outside every root are ignored
+    roots = {}
+    for path in map(os.path.normpath, paths):
+        for root_dir in root_dirs:
+            if path.startswith(os.path.normpath(root_dir) + os.sep):
+                roots.setdefault(root_dir, set()).add(path)
+
+    return roots
+
+def update(changed, folder_functions, file_functions, root_dirs=results.ROOT_DIRS, column='Retrieval Time (ms)'):
+    # Recompute the outputs depending on the changed paths. Errors are logged, not raised,
+    # so that a bad CSV doesn't stop the watch.
+    for path in changed:
+        if results.records_memory is not None and not os.path.exists(path):
+            results.records_memory.pop(os.path.abspath(path), None)
+
+    errors = []
+    for root_dir, paths in affected_roots(changed, root_dirs).items():
+        files = {path for path in paths if path.endswith('.csv')}
+        logger.info('Updating %s: %d changed files', root_dir, len(files))
+
+        try:
+            records = folders.ingest(root_dir, errors=errors)
+
+            # A directory moved away takes files of unknown experiments and clients with it
+            experiments = clients = None
+            if files == paths and len(records):
+                experiments = [experiment for experiment in records['Experiment'].unique() if experiment in {os.path.basename(os.path.dirname(path)) for path in files}]
+                clients = [client for client in sorted(records['Client'].unique()) if client in {folders.find_client(os.path.basename(path)) for path in files}]
+
+            folders.process_all(root_dir, column, folder_functions, records, incremental=True)
+            folders.process_experiments(root_dir, column, folder_functions, records, experiments, incremental=True)
+            folders.process_clients(root_dir, column, folder_functions, records, clients, incremental=True)
+
+            existing = {path for path in files if os.path.exists(path)}
+            results.process_csv_files(root_dir, column, file_functions, incremental=True, files=existing if experiments is not None else None)
+        except Exception as e:
+            traceback.print_exc()
+            errors.append(f'{root_dir}: {type(e).__name__}: {e}')
+
+    results.finish_rendering(keep_workers=True)
+    output_store.flush()
+
+    if affected_roots(changed, root_dirs):
+        # The tables of every campaign, from the records cached in memory
+        try:
+            tables.generate_tables(operation='retrieve')
+        except Exception as e:
+            traceback.print_exc()
+            errors.append(f'{tables.TABLES_FILE}: {type(e).__name__}: {e}')
+
+    for error in errors:
+        logger.error('\t%s', error)
+
+    return errors
+
+def watch(folder_functions, file_functions, records_dir=records_index.RECORDS_DIR, root_dirs=results.ROOT_DIRS, debounce=DEBOUNCE, poll=False, interval=POLL_INTERVAL):
+    results.keep_records_in_memory()
+
+    inotify = None if poll else open_inotify(records_dir)
+    if inotify is not None:
+        logger.info('Watching %d directories of %s with inotify', len(inotify['watches']), records_dir)
+        source = lambda timeout=None: read_inotify(inotify, timeout)
+    else:
+        logger.info('Polling %s every %s seconds', records_dir, interval)
+        source = polling_source(records_dir, interval)
+
+    # Bring every output up to date first, which also loads the records into memory
+    start = time.perf_counter()
+    update(set(records_index.find_record_files(records_dir)), folder_functions, file_functions, root_dirs)
+    logger.info('Up to date in %.1f s, waiting for changes', time.perf_counter() - start)
+
+    try:
+        while True:
+            changed = wait_for_changes(source, debounce)
+
+            start = time.perf_counter()
+            update(changed, folder_functions, file_functions, root_dirs)
+            logger.info('Updated %d changed paths in %.1f s', len(changed), time.perf_counter() - start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        results.finish_rendering()
+        if inotify is not None:
+            os.close(inotify['fd'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Keep the outputs of process_folders and process_results up to date as CSVs are added or changed')
+    parser.add_argument('--records-dir', default=records_index.RECORDS_DIR)
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE, help='seconds without new changes before updating the outputs')
+    parser.add_argument('--poll', action='store_true', help='poll the files instead of using inotify')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='seconds between two polls of the files')
+    parser.add_argument('--render-workers', type=int, default=os.cpu_count(), help='processes drawing the figures, kept between updates, 0 to draw them serially')
+    parser.add_argument('--outlier-method', metavar='METHOD', help="method of the outlier removal, e.g. 'iqr:k=3' or 'mad:z=3.5'")
+    parser.add_argument('--small-multiples', action='store_true', help='draw the histograms of all the sizes in one figure instead of one figure per size')
+    parser.add_argument('--output-mode', default='files', choices=['files', 'store'], help='store collects the tables into the consolidated output store instead of a file each')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level, format='%(message)s')
+    results.configure_rendering(cli_args.render_workers)
+
+    folder_functions = [dict(func_info) for func_info in folders.FUNCTIONS]
+    file_functions = [dict(func_info) for func_info in results.FUNCTIONS]
+
+    if cli_args.outlier_method:
+        folder_functions = results.use_outlier_method(folder_functions, cli_args.outlier_method)
+        file_functions = results.use_outlier_method(file_functions, cli_args.outlier_method)
+
+    if cli_args.small_multiples:
+        folder_functions = results.use_small_multiples(folder_functions)
+        file_functions = results.use_small_multiples(file_functions)
+
+    if cli_args.output_mode == 'store':
+        folder_functions = results.use_output_store(folder_functions)
+        file_functions = results.use_output_store(file_functions)
+
+    watch(folder_functions, file_functions, cli_args.records_dir, debounce=cli_args.debounce, poll=cli_args.poll, interval=cli_args.interval)